@@ -1,21 +1,139 @@
 #!/usr/bin/python3
 
+import argparse
+import io
+import os
 import pathlib
-import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import metrics
+from rasterizers import BACKENDS, CairoRasterizer, get_rasterizer
 
 srcdir = pathlib.Path('images')
 dstdir = pathlib.Path('pngs')
 
-if not srcdir.exists():
-    print("ERROR: Missing needed directory {!r} -- Please check README.".format(str(srcdir)))
-    exit()
 
-if not dstdir.exists():
-    dstdir.mkdir()
+def is_updated(srcpath, dstpath):
+    """Tell if the destination is newer than its source (the link or the image it points to)."""
+    if not dstpath.exists():
+        return False
+    src_mtime = max(srcpath.lstat().st_mtime, srcpath.stat().st_mtime)
+    return dstpath.stat().st_mtime >= src_mtime
 
-for srcpath in srcdir.iterdir():
-    dstpath = dstdir / (srcpath.stem + '.png')
-    print("{} -> {}".format(srcpath, dstpath))
-    cmd = ['inkscape', '--export-png={}'.format(dstpath), str(srcpath)]
-    subprocess.run(cmd, check=True)
+
+def get_sources():
+    """Get all the images to convert, and where the result goes."""
+    for srcpath in sorted(srcdir.iterdir()):
+        if srcpath.name.startswith('.'):
+            # the downloads' internal store, not real images
+            continue
+        yield srcpath, dstdir / (srcpath.stem + '.png')
+
+
+def pixel_difference(png_a, png_b):
+    """Return the mean difference (0 to 1) between two PNGs, and if their sizes matched."""
+    from PIL import Image, ImageChops, ImageStat  # fades
+
+    image_a = Image.open(io.BytesIO(png_a)).convert('RGBA')
+    image_b = Image.open(io.BytesIO(png_b)).convert('RGBA')
+    same_size = image_a.size == image_b.size
+    if not same_size:
+        image_b = image_b.resize(image_a.size, Image.LANCZOS)
+    diff = ImageChops.difference(image_a, image_b)
+    return sum(ImageStat.Stat(diff).mean) / (4 * 255), same_size
+
+
+def compare(jobs, dpi, width, threshold):
+    """Compare the already converted images (by Inkscape) with what CairoSVG produces."""
+    rasterizer = CairoRasterizer(jobs, dpi, width)
+
+    def _compare(srcpath, dstpath):
+        rendered = rasterizer.render(srcpath.read_bytes(), is_svg=srcpath.suffix == '.svg')
+        return pixel_difference(dstpath.read_bytes(), rendered)
+
+    pairs = [(srcpath, dstpath) for srcpath, dstpath in get_sources() if dstpath.exists()]
+    print("Comparing {} images".format(len(pairs)))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            (dstpath, executor.submit(_compare, srcpath, dstpath)) for srcpath, dstpath in pairs]
+        results = [(future.result(), dstpath) for dstpath, future in futures]
+
+    different = 0
+    for (difference, same_size), dstpath in sorted(results, reverse=True):
+        if difference > threshold or not same_size:
+            different += 1
+            print("    {:6.2%}  {}{}".format(
+                difference, dstpath, "" if same_size else " (different size)"))
+    print("Done, {} of {} images are different".format(different, len(results)))
+
+
+def main(jobs, force, backend, dpi, width):
+    """Main entry point."""
+    if not dstdir.exists():
+        dstdir.mkdir()
+
+    to_convert = [
+        (srcpath, dstpath) for srcpath, dstpath in get_sources()
+        if force or not is_updated(srcpath, dstpath)]
+    print("Converting {} images ({} jobs)".format(len(to_convert), jobs))
+    if not to_convert:
+        return
+    tini = time.monotonic()
+
+    # each conversion is done by a different process (or in C code with the GIL released), so
+    # threads are enough to use all the cores
+    rasterizer = get_rasterizer(backend, jobs, dpi, width)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                (srcpath, dstpath, executor.submit(rasterizer.convert, srcpath, dstpath))
+                for srcpath, dstpath in to_convert]
+            for idx, (srcpath, dstpath, future) in enumerate(futures, 1):
+                duration = future.result()
+                print(" {:5d}/{}  {:6.2f}s  {} -> {}".format(
+                    idx, len(futures), duration, srcpath, dstpath))
+                # the images are named after their country (see download_images.py)
+                metrics.record(
+                    'convert', duration, image=str(srcpath),
+                    country=srcpath.name.rsplit('.', 2)[0])
+    finally:
+        rasterizer.close()
+        metrics.save_report('convert_images')
+
+    print("Done in {:.2f}s".format(time.monotonic() - tini))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count(),
+        help="How many conversions to run in parallel (default: %(default)s, all the cores).")
+    parser.add_argument(
+        '--force', action='store_true', help="Convert all images, even if already up to date.")
+    parser.add_argument(
+        '--backend', choices=sorted(BACKENDS), default='shell',
+        help=(
+            "Convert in long-lived Inkscape shells (the default, falling back to 'process' "
+            "if not possible), in a new Inkscape process per file, or in this same process "
+            "using CairoSVG."))
+    parser.add_argument('--dpi', type=float, help="The resolution of the resulting images.")
+    parser.add_argument('--width', type=int, help="The width of the resulting images, in pixels.")
+    parser.add_argument(
+        '--compare', action='store_true',
+        help=(
+            "Don't convert, but compare the already converted images with what the CairoSVG "
+            "backend produces, showing those that differ more than the --threshold."))
+    parser.add_argument(
+        '--threshold', type=float, default=0.01,
+        help="Mean pixel difference (0 to 1) to consider images different (default: %(default)s).")
+    args = parser.parse_args()
+
+    if not srcdir.exists():
+        print("ERROR: Missing needed directory {!r} -- Please check README.".format(str(srcdir)))
+        exit()
+
+    if args.compare:
+        compare(args.jobs, args.dpi, args.width, args.threshold)
+    else:
+        main(args.jobs, args.force, args.backend, args.dpi, args.width)
@@ -0,0 +1 @@
+../raw/countries_store.py
\ No newline at end of file
@@ -0,0 +1,29 @@
+"""Put together all the cards of one side in a single PDF (the deck)."""
+
+import os
+
+DECK_FRONT = os.path.join('..', 'final-front.pdf')
+DECK_BACK = os.path.join('..', 'final-back.pdf')
+
+
+def assemble(card_paths, deck_path):
+    """Build the deck with the pages of all the card PDFs, in that order.
+
+    Each card is read and its page added one at a time; the objects that are exactly the same
+    in several cards (e.g. an image embedded in all of them) are stored only once. The deck is
+    not streamed: it's kept in memory and written at the end (pypdf can't write it in parts).
+    """
+    import pypdf  # fades >=4.3
+
+    writer = pypdf.PdfWriter()
+    for card_path in card_paths:
+        reader = pypdf.PdfReader(card_path)
+        for page in reader.pages:
+            writer.add_page(page)
+    writer.compress_identical_objects()
+
+    tmp_path = deck_path + '.tmp'
+    with open(tmp_path, "wb") as fh:
+        writer.write(fh)
+    os.replace(tmp_path, deck_path)
+    return len(writer.pages)
@@ -1,19 +1,60 @@
 #!/usr/bin/env fades
 
 import argparse
+import hashlib
 import os
 import json
 import operator
+import pathlib
 import random
+import tempfile
+import time
 import unicodedata
 from collections import defaultdict
-
-import certg  # fades >=5
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# what the helper modules need, declared here as fades only reads the script it runs
+import certg  # NOQA  # fades >=5
+import PIL  # NOQA  # fades
+import pypdf  # NOQA  # fades >=4.3
+
+import deck
+import imagecache
+import layoutfit
+import metrics
+import preview
+import templates
+from countries_store import STORE_FILEPATH, CountryStore, load_db
+from rasterizers import BACKENDS, get_rasterizer
 
 RESULT_DIR = 'result'
 
-PROCESSED_OK = 'ok'
-PROCESSED_FLAG = "__processed__"
+# the id of each card (a country name to a two digits hex code), kept along the data so cards
+# always have the same id even if countries are added or removed; new ones are taken in a
+# (seeded, so reproducible) random order, to not guess country position in the alphabet
+CARD_IDS_FILEPATH = 'card_ids.json'
+CARD_IDS_SEED = 'flagsy'
+MAX_CARD_ID = 0xFF
+
+# the hash of the inputs of each rendered card, to only render again those that changed
+MANIFEST_FILEPATH = os.path.join(RESULT_DIR, '.manifest.json')
+
+# the template for the back of each card, according to its style
+TEMPLATE_FRONT = 'card-front.svg'
+TEMPLATE_STYLES = {
+    None: 'card-back-common.svg',
+    "long-languages": 'card-back-lang.svg',
+    "long-demonyms": 'card-back-dem.svg',
+    "long-languages-and-countryname": 'card-back-lang-cntry.svg',
+    "long-countryname": 'card-back-cntry.svg',
+}
+
+# the back templates, from the one with less room for texts to the one with more
+STYLES_BY_ROOM = [
+    None, "long-languages", "long-demonyms", "long-countryname", "long-languages-and-countryname"]
+
+# how often to check for changes when watching, in seconds
+WATCH_INTERVAL = 1
 
 
 def cback(data):
@@ -21,7 +62,244 @@ def cback(data):
     print(" ", data['progress'])
 
 
-def generate_fronts(db, country=None):
+def _process_measured(*args, **kwargs):
+    """Render the cards in a worker process, bringing back the metrics recorded there."""
+    return templates.process(*args, **kwargs), metrics.pop_events()
+
+
+def result_path(result_prefix, card):
+    """Return the path of the PDF for a card, as `templates.process` names it."""
+    return "{}-{}.pdf".format(result_prefix, card['reduced_name'].lower().replace(' ', ''))
+
+
+class BuildManifest:
+    """Remember a hash of all the inputs of each rendered card.
+
+    The hash covers the template, the values substituted in it and the bytes of the images
+    placed in it, so if none of them changed the card doesn't need to be rendered again.
+    """
+
+    def __init__(self, filepath=MANIFEST_FILEPATH):
+        self.filepath = filepath
+        if os.path.exists(filepath):
+            with open(filepath, "rt", encoding="utf8") as fh:
+                self.hashes = json.load(fh)
+        else:
+            self.hashes = {}
+
+    def card_hash(self, template_content, card, image_info):
+        """Hash the inputs of a card."""
+        hasher = hashlib.sha256(template_content)
+        # the progress text depends on the rest of the deck, not on this card
+        fields = {key: value for key, value in card.items() if key != 'progress'}
+        hasher.update(json.dumps(fields, sort_keys=True).encode('utf8'))
+        for info in image_info:
+            with open(card[info['path_variable']], "rb") as fh:
+                hasher.update(hashlib.sha256(fh.read()).digest())
+        return hasher.hexdigest()
+
+    def is_updated(self, path, card_hash):
+        """Tell if the card's PDF is there and was rendered from the same inputs."""
+        return self.hashes.get(path) == card_hash and os.path.exists(path)
+
+    def update(self, path, card_hash):
+        """Record that the card was rendered from those inputs."""
+        self.hashes[path] = card_hash
+
+    def save(self):
+        """Save the manifest atomically."""
+        tmp_filepath = self.filepath + '.tmp'
+        with open(tmp_filepath, "wt", encoding="utf8") as fh:
+            json.dump(self.hashes, fh, indent=2, sort_keys=True)
+        os.replace(tmp_filepath, self.filepath)
+
+
+class Renderer:
+    """Render the cards from the compiled templates, here or among several processes.
+
+    Only the cards whose inputs changed since they were rendered are processed, unless forced.
+    If a DPI is given, the images are first resampled to their size in the card at that
+    resolution (see `imagecache`). If `per_card`, each card is rendered on its own in the pool
+    (even with only one job), showing how long it took since it was asked.
+    """
+
+    manifest_filepath = MANIFEST_FILEPATH
+
+    def __init__(self, jobs=1, force=False, dpi=None, per_card=False):
+        self.jobs = jobs
+        self.force = force
+        self.dpi = dpi
+        self.per_card = per_card
+        self.manifest = BuildManifest(self.manifest_filepath)
+        self.executor = self._build_executor()
+        self.futures = []
+
+    def _build_executor(self):
+        """Build the pool to render the cards in, if needed."""
+        if self.jobs > 1 or self.per_card:
+            # the workers start with no metrics (not those inherited when forked)
+            return ProcessPoolExecutor(max_workers=self.jobs, initializer=metrics.reset)
+
+    def _result_path(self, result_prefix, card):
+        """Return where the card is rendered."""
+        return result_path(result_prefix, card)
+
+    def _prepare_images(self, svg_source, replace_info, image_info):
+        """Point the cards to their images resampled for the placements in the template."""
+        template = templates.get_template(svg_source, image_info)
+        placements = [
+            segment for segment in template.segments
+            if isinstance(segment, templates.ImagePlacement)]
+
+        prepared_info = []
+        for card in replace_info:
+            card = dict(card)
+            for placement in placements:
+                card[placement.path_variable] = imagecache.prepare(
+                    card[placement.path_variable], placement, self.dpi)
+            prepared_info.append(card)
+        return prepared_info
+
+    def _changed(self, svg_source, result_prefix, replace_info, image_info):
+        """Return the cards that need to be rendered, with their result path and hash."""
+        with open(svg_source, "rb") as fh:
+            template_content = fh.read()
+
+        changed = []
+        for card in replace_info:
+            path = self._result_path(result_prefix, card)
+            card_hash = self.manifest.card_hash(template_content, card, image_info)
+            if self.force or not self.manifest.is_updated(path, card_hash):
+                changed.append((card, path, card_hash))
+        return changed
+
+    def process(self, svg_source, result_prefix, replace_info, image_info):
+        """Render the cards from the template (maybe later, call `finish` to be sure)."""
+        if self.dpi is not None:
+            replace_info = self._prepare_images(svg_source, replace_info, image_info)
+        changed = self._changed(svg_source, result_prefix, replace_info, image_info)
+        if len(changed) < len(replace_info):
+            print("Skipping {} cards from {!r} already up to date".format(
+                len(replace_info) - len(changed), svg_source))
+        if changed:
+            self._render(svg_source, result_prefix, changed, image_info)
+
+    def _render(self, svg_source, result_prefix, changed, image_info):
+        """Render the changed cards."""
+        if not changed:
+            # nothing to split in chunks (e.g. a --country that matches no card)
+            return
+        if self.executor is None:
+            templates.process(
+                svg_source, result_prefix, "reduced_name", [card for card, _, _ in changed],
+                image_info, progress_cb=cback)
+            for _, path, card_hash in changed:
+                self.manifest.update(path, card_hash)
+            return
+
+        chunk_size = 1 if self.per_card else -(-len(changed) // self.jobs)
+        for pos in range(0, len(changed), chunk_size):
+            chunk = changed[pos:pos + chunk_size]
+            future = self.executor.submit(
+                _process_measured, svg_source, result_prefix, "reduced_name",
+                [card for card, _, _ in chunk], image_info, progress_cb=cback)
+            self.futures.append((future, chunk, time.monotonic()))
+
+    def wait(self):
+        """Wait for all the cards asked so far to be rendered, and save the manifest."""
+        futures = {future: (chunk, tini) for future, chunk, tini in self.futures}
+        self.futures = []
+        try:
+            for future in as_completed(futures):
+                chunk, tini = futures[future]
+                _, events = future.result()
+                metrics.extend(events)
+                for _, path, card_hash in chunk:
+                    self.manifest.update(path, card_hash)
+                    if self.per_card:
+                        print("  {} rendered in {:.2f}s".format(path, time.monotonic() - tini))
+        finally:
+            self.manifest.save()
+
+    def finish(self):
+        """Wait for all the cards to be rendered, and release the pool."""
+        try:
+            self.wait()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+
+
+class PreviewRenderer(Renderer):
+    """Render the cards as low resolution PNGs, and tile them in contact sheets.
+
+    The thumbnails are kept (and only rendered again if their inputs changed), and the
+    images used in them are the resampled ones, at the same low resolution.
+    """
+
+    manifest_filepath = preview.MANIFEST_FILEPATH
+
+    def __init__(self, jobs=1, force=False, dpi=preview.PREVIEW_DPI, backend='shell'):
+        if not os.path.exists(preview.PREVIEW_DIR):
+            os.mkdir(preview.PREVIEW_DIR)
+        if backend == 'cairo':
+            # only needed by this backend (see above why it's declared here)
+            import cairosvg  # NOQA  # fades
+        self.rasterizer = get_rasterizer(backend, jobs, dpi=dpi)
+        self.thumbnails = defaultdict(list)
+        super().__init__(jobs, force, dpi)
+
+    def _build_executor(self):
+        """The rasterizers convert in other processes (or releasing the GIL), use threads."""
+        return ThreadPoolExecutor(max_workers=self.jobs)
+
+    def _result_path(self, result_prefix, card):
+        """Return where the card's thumbnail goes."""
+        name = os.path.basename(result_prefix)
+        return os.path.join(preview.PREVIEW_DIR, "{}-{}.png".format(
+            name, card['reduced_name'].lower().replace(' ', '')))
+
+    def _convert(self, card, content, path):
+        """Rasterize the card's SVG; the result is as the workers' one (but metrics are here)."""
+        cback(card)
+        fd, svg_path = tempfile.mkstemp(suffix='.svg', dir=preview.PREVIEW_DIR)
+        with os.fdopen(fd, "wt", encoding="utf8") as fh:
+            fh.write(content)
+        try:
+            with metrics.measure('render', card=path, country=card['reduced_name']):
+                self.rasterizer.convert(pathlib.Path(svg_path), pathlib.Path(path))
+        finally:
+            os.remove(svg_path)
+        return path, []
+
+    def process(self, svg_source, result_prefix, replace_info, image_info):
+        """Render the thumbnails, remembering all of them for the contact sheets."""
+        name = os.path.basename(result_prefix)
+        self.thumbnails[name].extend(
+            self._result_path(result_prefix, card) for card in replace_info)
+        super().process(svg_source, result_prefix, replace_info, image_info)
+
+    def _render(self, svg_source, result_prefix, changed, image_info):
+        """Rasterize the changed cards."""
+        template = templates.get_template(svg_source, image_info)
+        for card, path, card_hash in changed:
+            future = self.executor.submit(self._convert, card, template.render(card), path)
+            self.futures.append((future, [(card, path, card_hash)], time.monotonic()))
+
+    def finish(self):
+        """Wait for all the thumbnails, and tile them."""
+        try:
+            super().finish()
+        finally:
+            self.rasterizer.close()
+
+        for name, thumbnails in sorted(self.thumbnails.items()):
+            sheet_prefix = os.path.join(preview.PREVIEW_DIR, "sheet-" + name)
+            for sheet_path in preview.make_contact_sheets(thumbnails, sheet_prefix):
+                print("Contact sheet:", sheet_path)
+
+
+def generate_fronts(db, renderer, country=None):
     """Generate the fronts with just the flags."""
     replace_info = []
     for item in db:
@@ -40,9 +318,8 @@ def generate_fronts(db, country=None):
         'placement': 'center',
     }]
 
-    certg.process(
-        "card-front.svg", os.path.join(RESULT_DIR, "card-front"), "reduced_name",
-        replace_info, image_info, progress_cb=cback)
+    renderer.process(
+        TEMPLATE_FRONT, os.path.join(RESULT_DIR, "card-front"), replace_info, image_info)
 
 
 def is_single(text):
@@ -51,16 +328,45 @@ def is_single(text):
     return not any(ind in text for ind in indicators)
 
 
-def generate_backs(db, country=None):
-    """Generate the backs with all the rest of the information."""
-    template_styles = {
-        None: 'card-back-common.svg',
-        "long-languages": 'card-back-lang.svg',
-        "long-demonyms": 'card-back-dem.svg',
-        "long-languages-and-countryname": 'card-back-lang-cntry.svg',
-        "long-countryname": 'card-back-cntry.svg',
+def back_texts(item):
+    """Return the texts to put in the back of the card."""
+    # no point on having both if they are the same
+    original_name = item['name_original']
+    if original_name == item['name_translated']:
+        original_name = ''
+
+    lang_title = "Idioma" if is_single(item['languages']) else "Idiomas"
+    demonym_title = "Gentilicio" if is_single(item['demonyms']) else "Gentilicios"
+
+    return {
+        'continent': item['continent'],
+        'capital': item['capital_name'],
+        'lang_title': lang_title,
+        'lang_content': item['languages'],
+        'demonym_title': demonym_title,
+        'demonym_content': item['demonyms'],
+        'codes': item['code'],
+        'original_name': original_name,
+        'translated_name': item['name_translated'],
+        'simple_name': item['name'],
     }
 
+
+def assign_styles(db):
+    """Set the style of the cards that don't have one, to use the smallest template that fits."""
+    candidates = [(style, TEMPLATE_STYLES[style]) for style in STYLES_BY_ROOM]
+    for item in db:
+        if 'style' in item:
+            # set by hand
+            continue
+        style, fits = layoutfit.choose(back_texts(item), candidates)
+        if not fits:
+            print("WARNING! The texts of {!r} don't fit in any template".format(item['name']))
+        item['style'] = style
+
+
+def generate_backs(db, renderer, country=None):
+    """Generate the backs with all the rest of the information."""
     per_style = defaultdict(list)
 
     for item in db:
@@ -68,33 +374,16 @@ def generate_backs(db, country=None):
             continue
 
         style = item.get('style')
-
-        # no point on having both if they are the same
-        original_name = item['name_original']
-        if original_name == item['name_translated']:
-            original_name = ''
-
-        lang_title = "Idioma" if is_single(item['languages']) else "Idiomas"
-        demonym_title = "Gentilicio" if is_single(item['demonyms']) else "Gentilicios"
-
-        template = template_styles[style]
-        per_style[template].append({
-            'continent': item['continent'],
-            'capital': item['capital_name'],
-            'lang_title': lang_title,
-            'lang_content': item['languages'],
-            'demonym_title': demonym_title,
-            'demonym_content': item['demonyms'],
-            'codes': item['code'],
-            'original_name': original_name,
-            'translated_name': item['name_translated'],
-            'simple_name': item['name'],
+        template = TEMPLATE_STYLES[style]
+        fields = back_texts(item)
+        fields.update({
             'wloc_path': item['wloc_path'],
             'progress': item['progress'],
             'reduced_name': item['reduced_name'],
             'idx': item['ridx'],
             'style': style or 'common',
         })
+        per_style[template].append(fields)
 
     image_info = [{
         'placement_rectangle_id': 'rect19351',
@@ -103,27 +392,47 @@ def generate_backs(db, country=None):
     }]
 
     for template, replace_info in per_style.items():
-        certg.process(
-            template, os.path.join(RESULT_DIR, "card-back"), "reduced_name",
-            replace_info, image_info, progress_cb=cback)
+        renderer.process(
+            template, os.path.join(RESULT_DIR, "card-back"), replace_info, image_info)
+
+
+def assign_card_ids(db, filepath=CARD_IDS_FILEPATH):
+    """Set the id of each card, keeping those already assigned and saving the new ones."""
+    if os.path.exists(filepath):
+        with open(filepath, "rt", encoding="utf8") as fh:
+            card_ids = json.load(fh)
+    else:
+        card_ids = {}
+
+    available = ["{:02X}".format(i) for i in range(1, MAX_CARD_ID + 1)]
+    random.Random(CARD_IDS_SEED).shuffle(available)
+    used = set(card_ids.values())
+    available = [card_id for card_id in available if card_id not in used]
+
+    for item in db:
+        if item['name'] not in card_ids:
+            if not available:
+                raise ValueError("No more card ids available for {!r}".format(item['name']))
+            card_ids[item['name']] = available.pop(0)
+        item['ridx'] = card_ids[item['name']]
+
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, "wt", encoding="utf8") as fh:
+        json.dump(card_ids, fh, indent=2, sort_keys=True, ensure_ascii=False)
+    os.replace(tmp_filepath, filepath)
 
 
 def load(dbpath):
     """Load the DB and pre fill it with more info."""
-    with open(dbpath, "rt", encoding="utf8") as fh:
-        db = json.load(fh)
-
-    db = [item for item in db if item.get(PROCESSED_FLAG) == PROCESSED_OK]
-    random_idxs = ["{:02X}".format(i) for i in range(1, len(db) + 1)]
-    random.shuffle(random_idxs)
+    db = load_db(dbpath, only_processed_ok=True)
+    assign_card_ids(db)
 
     for item in db:
-        # insert a reduced/normalized name for filepaths and everything, and a id to
-        # identify the cards later (randomized so can not guess country position in the alphabet)
+        # insert a reduced/normalized name for filepaths and everything (the card id to
+        # identify the cards later was already set)
         name = item['name'].replace('/', '').replace(' ', '')
         item['reduced_name'] = (
             unicodedata.normalize('NFKD', name).encode('ASCII', 'ignore').decode("ASCII").lower())
-        item['ridx'] = random_idxs.pop()
 
         name = item['name'].split('/')[0].strip()
         wloc_path = os.path.abspath("pngs/{}.location.png".format(name))
@@ -135,6 +444,8 @@ def load(dbpath):
         item['wloc_path'] = wloc_path
         item['wflag_path'] = wflag_path
 
+    assign_styles(db)
+
     # order and set the progress indicator
     db.sort(key=operator.itemgetter('reduced_name'))
     for idx, item in enumerate(db, 1):
@@ -144,22 +455,167 @@ def load(dbpath):
     return db
 
 
+def assemble_decks(db, fronts=True, backs=True):
+    """Put the cards of each side together in a single PDF."""
+    sides = []
+    if fronts:
+        sides.append(("card-front", deck.DECK_FRONT))
+    if backs:
+        sides.append(("card-back", deck.DECK_BACK))
+
+    for result_prefix, deck_path in sides:
+        card_paths = [result_path(os.path.join(RESULT_DIR, result_prefix), item) for item in db]
+        quant = deck.assemble(card_paths, deck_path)
+        print("Deck {!r} done, with {} cards".format(deck_path, quant))
+
+
+def _mtimes(paths):
+    """Return the modification time of each path (None if it's not there)."""
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtimes[path] = None
+    return mtimes
+
+
+def _watched_paths(dbpath, db):
+    """Return all the files used to build the cards."""
+    paths = [dbpath, STORE_FILEPATH, TEMPLATE_FRONT] + sorted(set(TEMPLATE_STYLES.values()))
+    for item in db:
+        paths.extend([item['wflag_path'], item['wloc_path']])
+    return paths
+
+
+def _record_key(item):
+    """Serialize the item to compare it with its previous version."""
+    # the progress text depends on the rest of the deck, not on this item
+    return json.dumps({k: v for k, v in item.items() if k != 'progress'}, sort_keys=True)
+
+
+def affected_cards(db, previous_db, changed_paths):
+    """Return the items whose fronts, and those whose backs, need to be rendered again."""
+    previous = {item['reduced_name']: _record_key(item) for item in previous_db}
+    fronts = []
+    backs = []
+    for item in db:
+        data_changed = previous.get(item['reduced_name']) != _record_key(item)
+        if data_changed or TEMPLATE_FRONT in changed_paths or item['wflag_path'] in changed_paths:
+            fronts.append(item)
+        template = TEMPLATE_STYLES[item.get('style')]
+        if data_changed or template in changed_paths or item['wloc_path'] in changed_paths:
+            backs.append(item)
+    return fronts, backs
+
+
+def _import_json(dbpath):
+    """Put in the store (if there is one) the changes done by hand to the JSON file."""
+    if not os.path.exists(STORE_FILEPATH):
+        return
+    print("Importing {!r} in the store".format(dbpath))
+    store = CountryStore(STORE_FILEPATH)
+    try:
+        store.import_json(dbpath)
+    finally:
+        store.close()
+
+
+def watch(dbpath, args):
+    """Render again the affected cards every time a template, the data or an image changes.
+
+    The data is read from the store if present, so the changes to the JSON file are imported
+    there first.
+    """
+    dpi = None if args.original_images else args.dpi
+    renderer = Renderer(args.jobs, force=args.force, dpi=dpi, per_card=True)
+    db = load(dbpath)
+    mtimes = _mtimes(_watched_paths(dbpath, db))
+
+    # start with all the cards up to date
+    changed_paths = set(mtimes)
+    previous_db = []
+    print("Watching {} files for changes (Ctrl-C to stop)".format(len(mtimes)))
+    try:
+        while True:
+            tini = time.monotonic()
+            fronts, backs = affected_cards(db, previous_db, changed_paths)
+            try:
+                if not args.only_backs:
+                    generate_fronts(fronts, renderer)
+                if not args.only_fronts:
+                    generate_backs(backs, renderer)
+                renderer.wait()
+            except Exception as err:
+                print("ERROR: rendering failed: {}".format(err))
+            else:
+                if fronts or backs:
+                    print("Done in {:.2f}s".format(time.monotonic() - tini))
+
+            changed_paths = set()
+            while not changed_paths:
+                time.sleep(WATCH_INTERVAL)
+                current = _mtimes(mtimes)
+                changed_paths = {path for path, mtime in current.items() if mtimes[path] != mtime}
+                mtimes = current
+            print("Changed:", ", ".join(sorted(changed_paths)))
+
+            previous_db = db
+            if dbpath in changed_paths or STORE_FILEPATH in changed_paths:
+                try:
+                    if dbpath in changed_paths:
+                        _import_json(dbpath)
+                    db = load(dbpath)
+                except Exception as err:
+                    print("ERROR: could not load {!r}: {}".format(dbpath, err))
+                    # nothing to render, until it's fixed
+                    changed_paths = set()
+                    continue
+                mtimes = _mtimes(_watched_paths(dbpath, db))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        renderer.finish()
+
+
 def main(dbpath, args):
     """Main entry point."""
     if not os.path.exists(RESULT_DIR):
         os.mkdir(RESULT_DIR)
 
+    if args.watch:
+        watch(dbpath, args)
+        return
+
     db = load(dbpath)
+    if args.preview:
+        renderer = PreviewRenderer(args.jobs, force=args.force, backend=args.backend)
+    else:
+        dpi = None if args.original_images else args.dpi
+        renderer = Renderer(args.jobs, force=args.force, dpi=dpi)
     if not args.only_backs:
-        generate_fronts(db, country=args.country)
+        generate_fronts(db, renderer, country=args.country)
     if not args.only_fronts:
-        generate_backs(db, country=args.country)
+        generate_backs(db, renderer, country=args.country)
+    renderer.finish()
+
+    if args.deck and not args.preview:
+        assemble_decks(db, fronts=not args.only_backs, backs=not args.only_fronts)
+
+    # the cards were measured by their reduced name, report the country as the other steps
+    names = {item['reduced_name']: item['name'] for item in db}
+    events = metrics.pop_events()
+    for event in events:
+        if 'country' in event:
+            event['country'] = names.get(event['country'], event['country'])
+    metrics.extend(events)
+    metrics.save_report('generate_cards')
 
 
 if __name__ == "__main__":
+    # the SQLite store is used if present (see countries_store.py)
     fpath = 'countries_data.json'
-
-    if not os.path.exists(fpath):
+    if not os.path.exists(fpath) and not os.path.exists(STORE_FILEPATH):
         print("ERROR: Missing needed file {!r} -- Please check README.".format(fpath))
         exit()
 
@@ -167,6 +623,34 @@ if __name__ == "__main__":
     parser.add_argument('--only-backs', action='store_true')
     parser.add_argument('--only-fronts', action='store_true')
     parser.add_argument('--country', action='store')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, help="How many processes to render cards in.")
+    parser.add_argument(
+        '--force', action='store_true', help="Render all cards, even if already up to date.")
+    parser.add_argument(
+        '--dpi', type=float, default=imagecache.DEFAULT_DPI,
+        help="Resolution to resample the images to their size in the card (default: %(default)s).")
+    parser.add_argument(
+        '--original-images', action='store_true',
+        help="Use the images as they are, without resampling them.")
+    parser.add_argument(
+        '--deck', action='store_true',
+        help="Also put all the cards of each side together in a single PDF (the final decks).")
+    parser.add_argument(
+        '--preview', action='store_true',
+        help=(
+            "Instead of the PDFs, render all the cards as small PNGs in the {!r} directory, "
+            "tiled in a few contact sheets.".format(preview.PREVIEW_DIR)))
+    parser.add_argument(
+        '--backend', choices=sorted(BACKENDS), default='shell',
+        help="How to rasterize the previews (see convert_images.py).")
+    parser.add_argument(
+        '--watch', action='store_true',
+        help=(
+            "Keep running, rendering again the cards affected by any change in the templates, "
+            "the data or the images."))
     args = parser.parse_args()
+    if args.watch and args.preview:
+        parser.error("--watch can not be used with --preview")
 
     main(fpath, args)
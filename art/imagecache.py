@@ -0,0 +1,63 @@
+"""Keep the images resampled to the size they have in the cards, at print resolution.
+
+The converted images can be much bigger than what fits in a 60x90mm card, so each one is
+resampled once to the size of the place where it goes (at the given DPI) and kept in a
+directory, named by the hash of the original image and the resulting size; next runs just
+reuse them while the original doesn't change.
+"""
+
+import hashlib
+import os
+
+import certg  # fades >=5
+
+import templates
+
+PREPARED_DIR = 'prepared'
+DEFAULT_DPI = 300
+
+MM_PER_INCH = 25.4
+
+
+def _hash_file(path):
+    """Return the SHA-256 of the file's content."""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(64 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def prepare(image_path, placement, dpi=DEFAULT_DPI):
+    """Return the path of the image resampled for its placement in the template.
+
+    The sizes in the templates are in millimeters. Images are never enlarged: if the original
+    is already small enough, its path is returned.
+    """
+    from PIL import Image  # fades
+
+    image_size = templates.get_image_size(image_path)
+    if placement.placement == certg.Placement.center:
+        _, _, width_mm, height_mm = placement.geometry(image_size)
+    else:
+        width_mm, height_mm = placement.width, placement.height
+    width = max(1, round(width_mm * dpi / MM_PER_INCH))
+    height = max(1, round(height_mm * dpi / MM_PER_INCH))
+    if width >= image_size[0] and height >= image_size[1]:
+        return image_path
+
+    prepared_path = os.path.abspath(os.path.join(
+        PREPARED_DIR, "{}-{}x{}.png".format(_hash_file(image_path), width, height)))
+    if os.path.exists(prepared_path):
+        return prepared_path
+
+    if not os.path.exists(PREPARED_DIR):
+        os.makedirs(PREPARED_DIR, exist_ok=True)
+    with Image.open(image_path) as image:
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA')
+        resampled = image.resize((width, height), Image.LANCZOS)
+    tmp_path = prepared_path + '.tmp'
+    resampled.save(tmp_path, format='PNG', optimize=True)
+    os.replace(tmp_path, prepared_path)
+    return prepared_path
@@ -0,0 +1,206 @@
+#!/usr/bin/env fades
+
+"""Lay out the cards of the decks in printing sheets, several cards per sheet.
+
+The resulting PDF alternates a sheet of fronts and a sheet of the backs of the same cards,
+ready to be printed in duplex flipping the sheet over its side (that is the long edge for
+portrait sheets, the short edge for landscape ones); in the backs sheets the columns are
+mirrored, so each back ends up behind its front (and the code in the card's corner matches).
+
+The fronts are landscape and the backs portrait, so the backs are turned a quarter (counter
+clockwise, their top to the left of the sheet) to take exactly the place of their fronts.
+
+The cards have no artwork beyond their borders, so the bleed is a free space kept around each
+card, for the cut to be a bit off without reaching the neighbour cards.
+"""
+
+import argparse
+import math
+import os
+
+import deck
+
+MM = 72 / 25.4  # PDF points in a millimeter
+
+PAPER_SIZES = {
+    'a4': (210 * MM, 297 * MM),
+    'letter': (215.9 * MM, 279.4 * MM),
+}
+
+SHEETS_PATH = os.path.join('..', 'final-sheets.pdf')
+
+CROP_MARK_LENGTH = 3 * MM
+CROP_MARK_OFFSET = 1 * MM  # separation between the mark and the cut
+CROP_MARK_WIDTH = 0.25
+
+
+class Layout:
+    """Where each card goes in the sheet."""
+
+    def __init__(self, paper_size, card_size, margin, bleed):
+        self.card_width, self.card_height = card_size
+        self.bleed = bleed
+        self.step_x = self.card_width + 2 * bleed
+        self.step_y = self.card_height + 2 * bleed
+
+        # use the sheet in the orientation where more cards fit
+        outer = 2 * (margin + CROP_MARK_OFFSET + CROP_MARK_LENGTH)
+        options = []
+        for width, height in (paper_size, paper_size[::-1]):
+            cols = int((width - outer) // self.step_x)
+            rows = int((height - outer) // self.step_y)
+            options.append((cols * rows, width, height, cols, rows))
+        quant, self.width, self.height, self.cols, self.rows = max(
+            options, key=lambda option: option[0])
+        if quant == 0:
+            raise ValueError("The cards don't fit in the paper")
+        self.per_sheet = quant
+
+        # the whole block of cards is centered in the sheet
+        self.x0 = (self.width - self.cols * self.step_x) / 2 + bleed
+        self.y0 = (self.height - self.rows * self.step_y) / 2 + bleed
+
+    def position(self, idx, mirrored=False):
+        """Return the lower left corner of the card in that place of the sheet."""
+        row, col = divmod(idx, self.cols)
+        if mirrored:
+            col = self.cols - 1 - col
+        x = self.x0 + col * self.step_x
+        # rows are filled from the top of the sheet
+        y = self.y0 + (self.rows - 1 - row) * self.step_y
+        return x, y
+
+    def crop_marks(self):
+        """Build the PDF drawing operations for the crop marks around the block of cards."""
+        cuts_x = []
+        for col in range(self.cols):
+            x = self.x0 + col * self.step_x
+            cuts_x.extend([x, x + self.card_width])
+        cuts_y = []
+        for row in range(self.rows):
+            y = self.y0 + row * self.step_y
+            cuts_y.extend([y, y + self.card_height])
+
+        bottom = self.y0 - self.bleed
+        top = self.y0 + self.rows * self.step_y - self.bleed
+        left = self.x0 - self.bleed
+        right = self.x0 + self.cols * self.step_x - self.bleed
+
+        near = CROP_MARK_OFFSET
+        far = CROP_MARK_OFFSET + CROP_MARK_LENGTH
+        lines = []
+        for x in cuts_x:
+            lines.append((x, bottom - near, x, bottom - far))
+            lines.append((x, top + near, x, top + far))
+        for y in cuts_y:
+            lines.append((left - near, y, left - far, y))
+            lines.append((right + near, y, right + far, y))
+
+        operations = ["{} w 0 G".format(CROP_MARK_WIDTH)]
+        operations.extend(
+            "{:.3f} {:.3f} m {:.3f} {:.3f} l S".format(*line) for line in lines)
+        return "\n".join(operations).encode('ascii')
+
+
+def _card_size(page):
+    """Return the width and height of the card's page."""
+    box = page.mediabox
+    return float(box.width), float(box.height)
+
+
+def _same_size(size1, size2):
+    """Tell if both sizes are the same (within a small fraction of a millimeter)."""
+    return all(math.isclose(v1, v2, abs_tol=0.1 * MM) for v1, v2 in zip(size1, size2))
+
+
+def placement(layout, idx, page, mirrored=False):
+    """Return the transformation to put the page in that place of the sheet.
+
+    If the page is in the other orientation than the layout's cards, it's turned a quarter
+    counter clockwise to fit in its place.
+    """
+    import pypdf  # fades >=4.3
+
+    box = page.mediabox
+    width, height = _card_size(page)
+    x, y = layout.position(idx, mirrored=mirrored)
+    transformation = pypdf.Transformation().translate(-float(box.left), -float(box.bottom))
+    if _same_size((width, height), (layout.card_width, layout.card_height)):
+        return transformation.translate(x, y)
+    if _same_size((height, width), (layout.card_width, layout.card_height)):
+        # once turned, the page's lower left corner is the lower right one of the place
+        return transformation.rotate(90).translate(x + height, y)
+    raise ValueError("The page size ({:.1f}x{:.1f} mm) doesn't match the card's one".format(
+        width / MM, height / MM))
+
+
+def impose(front_path, back_path, sheets_path, paper='a4', margin=3 * MM, bleed=2 * MM):
+    """Build the sheets PDF from the decks, returning its layout and how many sheets it has."""
+    import pypdf  # fades >=4.3
+    from pypdf.generic import DecodedStreamObject
+
+    fronts = pypdf.PdfReader(front_path).pages
+    backs = pypdf.PdfReader(back_path).pages
+    if len(fronts) != len(backs):
+        raise ValueError("The decks have different quantity of cards: {} fronts, {} backs".format(
+            len(fronts), len(backs)))
+
+    writer = pypdf.PdfWriter()
+    layout = None
+    sheets = 0
+
+    def new_sheet():
+        sheet = writer.add_blank_page(layout.width, layout.height)
+        marks = DecodedStreamObject()
+        marks.set_data(layout.crop_marks())
+        sheet.replace_contents(marks)
+        return sheet
+
+    front_sheet = back_sheet = None
+    idx = 0
+    for front, back in zip(fronts, backs):
+        if layout is None:
+            layout = Layout(PAPER_SIZES[paper], _card_size(front), margin, bleed)
+        if idx == 0:
+            front_sheet = new_sheet()
+            back_sheet = new_sheet()
+            sheets += 1
+
+        for sheet, page, mirrored in ((front_sheet, front, False), (back_sheet, back, True)):
+            sheet.merge_transformed_page(page, placement(layout, idx, page, mirrored=mirrored))
+        idx = (idx + 1) % layout.per_sheet
+
+    writer.compress_identical_objects()
+    tmp_path = sheets_path + '.tmp'
+    with open(tmp_path, "wb") as fh:
+        writer.write(fh)
+    os.replace(tmp_path, sheets_path)
+    return layout, sheets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paper', choices=sorted(PAPER_SIZES), default='a4')
+    parser.add_argument(
+        '--margin', type=float, default=3,
+        help=(
+            "Minimum space to leave in the sheet borders (beyond the crop marks), "
+            "in mm (default: %(default)s)."))
+    parser.add_argument(
+        '--bleed', type=float, default=2,
+        help="Space to leave around each card, in mm (default: %(default)s).")
+    args = parser.parse_args()
+
+    for deck_path in (deck.DECK_FRONT, deck.DECK_BACK):
+        if not os.path.exists(deck_path):
+            print("ERROR: Missing needed file {!r} -- Please check README.".format(deck_path))
+            exit()
+
+    layout, sheets = impose(
+        deck.DECK_FRONT, deck.DECK_BACK, SHEETS_PATH, paper=args.paper,
+        margin=args.margin * MM, bleed=args.bleed * MM)
+    landscape = layout.width > layout.height
+    print("Done, {} sheets of fronts and backs ({} cards each) in {!r}".format(
+        sheets, layout.per_sheet, SHEETS_PATH))
+    print("Print them in duplex, {}, flipping on the {} edge".format(
+        "landscape" if landscape else "portrait", "short" if landscape else "long"))
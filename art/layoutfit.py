@@ -0,0 +1,228 @@
+"""Choose the back template for each card according to what fits in it.
+
+The text boxes of each template (the flowed texts with variables in them) are taken from the
+SVG with their real size in the card, and the card's texts are measured with the font metrics
+and wrapped in those boxes; each box has room for as many lines as fit until the next box
+below (or the image), keeping a minimum gap. The smallest template where all the texts fit
+is the one to use.
+"""
+
+import functools
+import math
+import os
+import re
+import xml.etree.ElementTree as ET
+
+# the line height to use if the template doesn't specify it (relative to the font size), and
+# the minimum space to keep between the last line of a text and what is below (in mm)
+DEFAULT_LINE_HEIGHT = 1.25
+MIN_GAP = 1
+
+# the font files to measure each family (first found is used), and the size to measure them
+FONT_FILES = {
+    'Ubuntu': ['Ubuntu-R.ttf', 'Ubuntu-Regular.ttf'],
+    'sans-serif': ['DejaVuSans.ttf', 'LiberationSans-Regular.ttf'],
+}
+FALLBACK_FONT_FILES = ['DejaVuSans.ttf', 'LiberationSans-Regular.ttf']
+REFERENCE_SIZE = 100
+
+RE_SHAPE_INSIDE = re.compile(r"shape-inside:url\(#([\w\-]+)\)")
+RE_FONT_SIZE = re.compile(r"font-size:([\d.]+)px")
+RE_FONT_FAMILY = re.compile(r"font-family:'?([^;'\"]+)'?")
+RE_LINE_HEIGHT = re.compile(r"line-height:([\d.]+)(?:;|$)")
+RE_TRANSFORM = re.compile(r"(\w+)\(([^)]*)\)")
+RE_VARIABLE = re.compile(r"\{\{(\w+)\}\}")
+
+# the rectangle where the image goes, the limit for the texts above it
+IMAGE_RECTANGLE_ID = 'rect19351'
+
+IDENTITY = (1, 0, 0, 1, 0, 0)
+
+
+def _multiply(m1, m2):
+    """Multiply two SVG transformation matrices."""
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (
+        a1 * a2 + c1 * b2, b1 * a2 + d1 * b2, a1 * c2 + c1 * d2, b1 * c2 + d1 * d2,
+        a1 * e2 + c1 * f2 + e1, b1 * e2 + d1 * f2 + f1)
+
+
+def parse_transform(transform):
+    """Convert an SVG transform attribute to its matrix."""
+    matrix = IDENTITY
+    for name, raw_args in RE_TRANSFORM.findall(transform or ''):
+        args = [float(arg) for arg in re.split(r"[\s,]+", raw_args.strip())]
+        if name == 'matrix':
+            step = tuple(args)
+        elif name == 'translate':
+            step = (1, 0, 0, 1, args[0], args[1] if len(args) > 1 else 0)
+        elif name == 'scale':
+            step = (args[0], 0, 0, args[-1], 0, 0)
+        elif name == 'rotate':
+            angle = math.radians(args[0])
+            step = (math.cos(angle), math.sin(angle), -math.sin(angle), math.cos(angle), 0, 0)
+        else:
+            raise ValueError("Transform not supported: {!r}".format(name))
+        matrix = _multiply(matrix, step)
+    return matrix
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(family):
+    """Load the font for the family, at the reference size.
+
+    If the family's font is not installed other one is used, warning about it (only once, as
+    the font is cached), as the texts would be measured wrongly.
+    """
+    from PIL import ImageFont  # fades
+
+    family_files = FONT_FILES.get(family, [])
+    for filename in family_files + FALLBACK_FONT_FILES:
+        try:
+            font = ImageFont.truetype(filename, REFERENCE_SIZE)
+        except OSError:
+            continue
+        if filename not in family_files:
+            print("WARNING! Font for {!r} not found, measuring the texts with {!r}".format(
+                family, filename))
+        return font
+    print("WARNING! Font for {!r} not found, measuring the texts with the default one".format(
+        family))
+    return ImageFont.load_default(size=REFERENCE_SIZE)
+
+
+@functools.lru_cache(maxsize=None)
+def text_width(family, size, text):
+    """Return the width of the text in that font family and size."""
+    return load_font(family).getlength(text) * size / REFERENCE_SIZE
+
+
+def count_lines(text, width, family, size):
+    """Return how many lines the text takes wrapped in that width (inf if a word doesn't fit)."""
+    lines = 0
+    for paragraph in text.split('\n'):
+        lines += 1
+        line = ''
+        for word in paragraph.split():
+            if text_width(family, size, word) > width:
+                return math.inf
+            candidate = word if not line else line + ' ' + word
+            if line and text_width(family, size, candidate) > width:
+                lines += 1
+                line = word
+            else:
+                line = candidate
+    return lines
+
+
+class TextBox:
+    """A box in the template where a text with variables flows."""
+
+    def __init__(self, text, width, top, family, size, line_height):
+        self.text = text
+        self.width = width
+        self.top = top
+        self.family = family
+        self.size = size
+        self.line_height = line_height
+
+    def render(self, fields):
+        """Return the box's text for the card."""
+        return RE_VARIABLE.sub(lambda match: fields.get(match.group(1)) or "", self.text)
+
+
+class Layout:
+    """The text boxes of a template, and the limit for them below."""
+
+    def __init__(self, svg_source):
+        self.svg_source = svg_source
+        root = ET.parse(svg_source).getroot()
+        rects = {elem.get('id'): elem for elem in root.iter() if elem.tag.endswith('}rect')}
+        self.boxes = []
+        self.bottom = math.inf
+        self._walk(root, IDENTITY, rects)
+
+    def _walk(self, elem, matrix, rects):
+        """Find the boxes (and the image) in the element and its children."""
+        matrix = _multiply(matrix, parse_transform(elem.get('transform')))
+        if elem.get('id') == IMAGE_RECTANGLE_ID:
+            self.bottom = self._point(matrix, elem.get('x'), elem.get('y'))[1]
+            return
+
+        if elem.tag.endswith('}text'):
+            shape = RE_SHAPE_INSIDE.search(elem.get('style', ''))
+            text = "".join(elem.itertext()).strip()
+            if shape is not None and RE_VARIABLE.search(text):
+                rect = rects.get(shape.group(1))
+                if rect is None:
+                    self._error(elem, "flows in {!r}, which is not a rectangle".format(
+                        shape.group(1)))
+                scale = math.sqrt(abs(matrix[0] * matrix[3] - matrix[1] * matrix[2]))
+                # the most specific style is the last one (in the inner tspan)
+                styles = [e.get('style', '') for e in elem.iter()]
+                sizes = [m for style in styles for m in RE_FONT_SIZE.findall(style)]
+                families = [m for style in styles for m in RE_FONT_FAMILY.findall(style)]
+                line_heights = [
+                    float(m) for style in styles for m in RE_LINE_HEIGHT.findall(style)]
+                if not sizes:
+                    self._error(elem, "has no font size")
+                if not families:
+                    self._error(elem, "has no font family")
+                self.boxes.append(TextBox(
+                    text=text,
+                    width=float(rect.get('width')) * scale,
+                    top=self._point(matrix, rect.get('x'), rect.get('y'))[1],
+                    family=families[-1].strip(),
+                    size=float(sizes[-1]) * scale,
+                    line_height=max(line_heights, default=0) or DEFAULT_LINE_HEIGHT))
+            return
+
+        for child in elem:
+            self._walk(child, matrix, rects)
+
+    def _error(self, elem, problem):
+        """Complain about a text box that can't be measured."""
+        raise ValueError("Bad template {!r}: the text {!r} {}".format(
+            self.svg_source, elem.get('id'), problem))
+
+    def _point(self, matrix, x, y):
+        """Apply the matrix to the point."""
+        a, b, c, d, e, f = matrix
+        x, y = float(x), float(y)
+        return a * x + c * y + e, b * x + d * y + f
+
+    def fits(self, fields):
+        """Tell if all the texts of the card fit in their boxes."""
+        filled = [(box, box.render(fields)) for box in self.boxes]
+        filled = sorted(
+            ((box, text) for box, text in filled if text.strip()), key=lambda pair: pair[0].top)
+        for idx, (box, text) in enumerate(filled):
+            below = filled[idx + 1][0].top if idx + 1 < len(filled) else self.bottom
+            pitch = box.size * box.line_height
+            room_lines = max(1, int((below - box.top - MIN_GAP) // pitch))
+            if count_lines(text, box.width, box.family, box.size) > room_lines:
+                return False
+        return True
+
+
+@functools.lru_cache(maxsize=None)
+def _get_layout(svg_source, mtime_ns):
+    """Parse the template; cached while the file doesn't change."""
+    return Layout(svg_source)
+
+
+def get_layout(svg_source):
+    """Get the layout of the template, parsing it only the first time (or if it changed)."""
+    return _get_layout(svg_source, os.stat(svg_source).st_mtime_ns)
+
+
+def choose(fields, candidates):
+    """Return the first of the candidates (name, template) where the card fits, and if it fits.
+
+    If it doesn't fit in any, the last candidate is returned.
+    """
+    for name, svg_source in candidates:
+        if get_layout(svg_source).fits(fields):
+            return name, True
+    return name, False
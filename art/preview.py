@@ -0,0 +1,50 @@
+"""Tile the cards' thumbnails in a few big images, to check all of them at a glance."""
+
+import math
+import os
+
+PREVIEW_DIR = 'preview'
+PREVIEW_DPI = 40
+
+# the hash of the inputs of each thumbnail, as the cards' manifest
+MANIFEST_FILEPATH = os.path.join(PREVIEW_DIR, '.manifest.json')
+
+SHEET_COLUMNS = 10
+SHEET_ROWS = 5
+SHEET_SPACING = 4  # pixels between thumbnails
+BACKGROUND = 'white'
+
+
+def make_contact_sheets(thumbnail_paths, sheet_prefix):
+    """Tile the thumbnails in as many images as needed; return their paths."""
+    from PIL import Image  # fades
+
+    thumbnails = [Image.open(path) for path in thumbnail_paths]
+    if not thumbnails:
+        return []
+    cell_width = max(thumbnail.width for thumbnail in thumbnails) + SHEET_SPACING
+    cell_height = max(thumbnail.height for thumbnail in thumbnails) + SHEET_SPACING
+
+    per_sheet = SHEET_COLUMNS * SHEET_ROWS
+    sheet_paths = []
+    for sheet_idx in range(math.ceil(len(thumbnails) / per_sheet)):
+        in_sheet = thumbnails[sheet_idx * per_sheet:(sheet_idx + 1) * per_sheet]
+        rows = math.ceil(len(in_sheet) / SHEET_COLUMNS)
+        columns = min(len(in_sheet), SHEET_COLUMNS)
+        sheet = Image.new(
+            'RGB', (columns * cell_width + SHEET_SPACING, rows * cell_height + SHEET_SPACING),
+            BACKGROUND)
+        for idx, thumbnail in enumerate(in_sheet):
+            row, col = divmod(idx, SHEET_COLUMNS)
+            x = SHEET_SPACING + col * cell_width + (cell_width - thumbnail.width) // 2
+            y = SHEET_SPACING + row * cell_height + (cell_height - thumbnail.height) // 2
+            thumbnail = thumbnail.convert('RGBA')
+            sheet.paste(thumbnail, (x, y), thumbnail)
+
+        sheet_path = "{}-{}.png".format(sheet_prefix, sheet_idx + 1)
+        sheet.save(sheet_path)
+        sheet_paths.append(sheet_path)
+
+    for thumbnail in thumbnails:
+        thumbnail.close()
+    return sheet_paths
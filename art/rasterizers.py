@@ -0,0 +1,288 @@
+"""Different ways of converting (rasterizing) the images to PNG.
+
+All of them have the same interface: build them with the desired DPI and/or width (in pixels),
+call `convert(srcpath, dstpath)` as many times as needed (even from different threads), which
+returns how much time it took, and call `close()` at the end.
+"""
+
+import functools
+import io
+import os
+import queue
+import re
+import select
+import shlex
+import shutil
+import subprocess
+import time
+from urllib import parse, request
+
+# how much to wait for the Inkscape shell to answer (starting or converting), in seconds
+SHELL_TIMEOUT = 60
+
+# the only directory from where CairoSVG can read the files the SVGs refer to (the cards'
+# images are there); left on its own, it only reads data URLs
+FILES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# what an image that can not be read is replaced with (the same CairoSVG uses)
+EMPTY_SVG = b'<svg width="1" height="1"></svg>'
+
+
+@functools.lru_cache()
+def inkscape_is_modern():
+    """Tell if Inkscape is 1.x (which changed its command line and shell syntax) or older."""
+    proc = subprocess.run(
+        ['inkscape', '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True, check=True)
+    m = re.search(r'Inkscape (\d+)\.', proc.stdout)
+    return m is not None and int(m.group(1)) >= 1
+
+
+class Rasterizer:
+    """Base for all the rasterizers."""
+
+    def __init__(self, jobs=1, dpi=None, width=None):
+        self.jobs = jobs
+        self.dpi = dpi
+        self.width = width
+
+    def convert(self, srcpath, dstpath):
+        """Convert one image, returning how much time it took."""
+        raise NotImplementedError()
+
+    def close(self):
+        """Release all the used resources."""
+
+
+class InkscapeRasterizer(Rasterizer):
+    """Run a new Inkscape process for each image."""
+
+    def _build_options(self, dstpath):
+        """Build the command line options to export to the destination."""
+        if inkscape_is_modern():
+            options = ['--export-type=png', '--export-filename={}'.format(dstpath)]
+        else:
+            options = ['--export-png={}'.format(dstpath)]
+        if self.dpi is not None:
+            options.append('--export-dpi={}'.format(self.dpi))
+        if self.width is not None:
+            options.append('--export-width={}'.format(self.width))
+        return options
+
+    def convert(self, srcpath, dstpath):
+        """Convert one image, returning how much time it took."""
+        tini = time.monotonic()
+        cmd = ['inkscape'] + self._build_options(dstpath) + [str(srcpath)]
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        return time.monotonic() - tini
+
+
+class ShellError(Exception):
+    """The Inkscape shell crashed, hanged, or just didn't do what was asked."""
+
+
+class InkscapeShell:
+    """A long-lived Inkscape process in shell mode, to convert many images in it."""
+
+    def __init__(self, dpi=None, width=None):
+        self.dpi = dpi
+        self.width = width
+        self.proc = None
+        self.start()
+
+    def start(self):
+        """Start the process, waiting it to be ready."""
+        self.proc = subprocess.Popen(
+            ['inkscape', '--shell'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        self._wait_prompt()
+
+    def _wait_prompt(self):
+        """Read the output until the shell shows its prompt again."""
+        output = b''
+        fd = self.proc.stdout.fileno()
+        deadline = time.monotonic() + SHELL_TIMEOUT
+        while not output.rstrip(b' ').endswith(b'>'):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise ShellError("Timeout waiting the Inkscape shell")
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise ShellError("The Inkscape shell finished unexpectedly")
+            output += chunk
+        return output
+
+    def _build_command(self, srcpath, dstpath):
+        """Build the command to convert the image, in the syntax of the Inkscape's version."""
+        if inkscape_is_modern():
+            actions = ["file-open:{}".format(srcpath), "export-filename:{}".format(dstpath)]
+            if self.dpi is not None:
+                actions.append("export-dpi:{}".format(self.dpi))
+            if self.width is not None:
+                actions.append("export-width:{}".format(self.width))
+            actions.extend(["export-do", "file-close"])
+            return "; ".join(actions) + "\n"
+
+        parts = [shlex.quote(str(srcpath)), "--export-png={}".format(shlex.quote(str(dstpath)))]
+        if self.dpi is not None:
+            parts.append("--export-dpi={}".format(self.dpi))
+        if self.width is not None:
+            parts.append("--export-width={}".format(self.width))
+        return " ".join(parts) + "\n"
+
+    def convert(self, srcpath, dstpath):
+        """Convert one image, returning how much time it took."""
+        tini = time.monotonic()
+        if dstpath.exists():
+            dstpath.unlink()
+        command = self._build_command(srcpath, dstpath)
+        try:
+            self.proc.stdin.write(command.encode('utf8'))
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            raise ShellError("The Inkscape shell is not there anymore")
+        self._wait_prompt()
+        if not dstpath.exists():
+            raise ShellError("The Inkscape shell didn't convert {}".format(srcpath))
+        return time.monotonic() - tini
+
+    def restart(self):
+        """Kill the process and start a new one."""
+        self.proc.kill()
+        self.proc.wait()
+        self.start()
+
+    def close(self):
+        """Finish the process nicely."""
+        try:
+            self.proc.stdin.write(b"quit\n")
+            self.proc.stdin.close()
+            self.proc.wait(timeout=SHELL_TIMEOUT)
+        except (BrokenPipeError, subprocess.TimeoutExpired):
+            self.proc.kill()
+
+
+class InkscapeShellRasterizer(Rasterizer):
+    """Keep one long-lived Inkscape shell per job, converting the images in them."""
+
+    def __init__(self, jobs=1, dpi=None, width=None):
+        super().__init__(jobs, dpi, width)
+        self._fallback = InkscapeRasterizer(jobs, dpi, width)
+        self.shells = []
+        try:
+            for _ in range(jobs):
+                self.shells.append(InkscapeShell(dpi, width))
+        except Exception:
+            self.close()
+            raise
+        self.available = queue.Queue()
+        for shell in self.shells:
+            self.available.put(shell)
+
+    def convert(self, srcpath, dstpath):
+        """Convert one image in any available shell.
+
+        If something fails the shell is restarted and the conversion retried; if it fails
+        again, the image is converted in its own process.
+        """
+        shell = self.available.get()
+        try:
+            try:
+                return shell.convert(srcpath, dstpath)
+            except ShellError as err:
+                print("WARNING: restarting Inkscape shell after error:", err)
+            try:
+                shell.restart()
+                return shell.convert(srcpath, dstpath)
+            except ShellError as err:
+                print("WARNING: Inkscape shell failed again ({}), using a process for {}".format(
+                    err, srcpath))
+        finally:
+            self.available.put(shell)
+        return self._fallback.convert(srcpath, dstpath)
+
+    def close(self):
+        """Close all the shells."""
+        for shell in self.shells:
+            shell.close()
+
+
+def fetch_local(url, resource_type, files_dir=FILES_DIR):
+    """Get what an SVG refers to, only if embedded (a data URL) or a file inside the directory."""
+    if url.startswith('data:'):
+        with request.urlopen(url) as resp:
+            return resp.read()
+
+    parsed = parse.urlparse(url)
+    if parsed.scheme in ('', 'file'):
+        path = os.path.realpath(parse.unquote(parsed.path))
+        files_dir = os.path.realpath(files_dir)
+        if os.path.commonpath([path, files_dir]) == files_dir:
+            with open(path, "rb") as fh:
+                return fh.read()
+
+    print("WARNING! Not reading {!r} (only files in {!r} are allowed)".format(url, files_dir))
+    return EMPTY_SVG
+
+
+class CairoRasterizer(Rasterizer):
+    """Convert the images in this same process, using CairoSVG (and Pillow for bitmaps).
+
+    The files the SVGs refer to are only read from `files_dir`.
+    """
+
+    def __init__(self, jobs=1, dpi=None, width=None, files_dir=FILES_DIR):
+        super().__init__(jobs, dpi, width)
+        import cairosvg  # fades
+        self._cairosvg = cairosvg
+        self._url_fetcher = functools.partial(fetch_local, files_dir=files_dir)
+
+    def render(self, content, is_svg=True):
+        """Convert the image from its bytes, returning the PNG ones."""
+        if is_svg:
+            kwargs = {}
+            if self.dpi is not None:
+                kwargs['dpi'] = self.dpi
+            if self.width is not None:
+                kwargs['output_width'] = self.width
+            return self._cairosvg.svg2png(
+                bytestring=content, url_fetcher=self._url_fetcher, **kwargs)
+
+        from PIL import Image  # fades
+        image = Image.open(io.BytesIO(content))
+        if self.width is not None and image.width != self.width:
+            height = round(image.height * self.width / image.width)
+            image = image.resize((self.width, height), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format='PNG')
+        return output.getvalue()
+
+    def convert(self, srcpath, dstpath):
+        """Convert one image, returning how much time it took."""
+        tini = time.monotonic()
+        is_svg = srcpath.suffix.lower() == '.svg'
+        if not is_svg and self.width is None:
+            # nothing to do, just use the original bitmap
+            shutil.copyfile(str(srcpath), str(dstpath))
+        else:
+            dstpath.write_bytes(self.render(srcpath.read_bytes(), is_svg=is_svg))
+        return time.monotonic() - tini
+
+
+BACKENDS = {
+    'shell': InkscapeShellRasterizer,
+    'process': InkscapeRasterizer,
+    'cairo': CairoRasterizer,
+}
+
+
+def get_rasterizer(backend, jobs=1, dpi=None, width=None):
+    """Build the rasterizer for the backend; Inkscape's shell mode falls back to processes."""
+    if backend == 'shell':
+        try:
+            return InkscapeShellRasterizer(jobs, dpi, width)
+        except (ShellError, OSError, subprocess.CalledProcessError) as err:
+            print("WARNING: Inkscape's shell mode not available ({}), "
+                  "using a process per file".format(err))
+            backend = 'process'
+    return BACKENDS[backend](jobs, dpi, width)
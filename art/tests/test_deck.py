@@ -0,0 +1,32 @@
+import os
+import random
+
+import pypdf
+from PIL import Image
+
+from art import deck
+
+
+def _build_cards(tmp_path, quantity):
+    """Build card PDFs that embed the same image (which doesn't compress)."""
+    rnd = random.Random(0)
+    image = Image.frombytes('RGB', (100, 100), bytes(rnd.randrange(256) for _ in range(30000)))
+    card_paths = []
+    for idx in range(quantity):
+        card_path = str(tmp_path / "card-{}.pdf".format(idx))
+        image.save(card_path)
+        card_paths.append(card_path)
+    return card_paths
+
+
+def test_assemble_stores_shared_objects_once(tmp_path):
+    card_paths = _build_cards(tmp_path, 3)
+    deck_path = str(tmp_path / "deck.pdf")
+    assert deck.assemble(card_paths, deck_path) == 3
+
+    pages = pypdf.PdfReader(deck_path).pages
+    assert len(pages) == 3
+    images = {
+        xobject.idnum for page in pages for xobject in page['/Resources']['/XObject'].values()}
+    assert len(images) == 1
+    assert os.path.getsize(deck_path) < sum(os.path.getsize(path) for path in card_paths) / 2
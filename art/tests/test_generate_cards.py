@@ -0,0 +1,105 @@
+import json
+
+from art import generate_cards
+
+
+def test_renderer_nothing_to_render(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / generate_cards.RESULT_DIR).mkdir()
+    renderer = generate_cards.Renderer(jobs=4)
+    renderer._render('card-front.svg', 'result/card-front', [], [])
+    renderer.finish()
+    assert renderer.futures == []
+
+
+def test_watch_imports_json_edits(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    items = [
+        {'name': 'Cuba', 'url': 'https://es.wikipedia.org/wiki/Cuba', 'capital_name': 'Habana',
+         '__processed__': 'ok'},
+    ]
+    store = generate_cards.CountryStore(generate_cards.STORE_FILEPATH)
+    store.merge(items)
+    store.export_json('countries_data.json')
+    store.close()
+    assert generate_cards.STORE_FILEPATH in generate_cards._watched_paths(
+        'countries_data.json', [])
+
+    # an edit by hand to the JSON gets to the store, from where the cards' data is read
+    items[0]['capital_name'] = 'La Habana'
+    with open('countries_data.json', "wt", encoding="ascii") as fh:
+        json.dump(items, fh)
+    generate_cards._import_json('countries_data.json')
+    (item,) = generate_cards.load_db('countries_data.json', only_processed_ok=True)
+    assert item['capital_name'] == 'La Habana'
+
+
+def _card_ids(db, filepath):
+    generate_cards.assign_card_ids(db, filepath)
+    return {item['name']: item['ridx'] for item in db}
+
+
+def test_card_ids_kept(tmp_path):
+    filepath = str(tmp_path / 'card_ids.json')
+    first = _card_ids([{'name': 'Cuba'}, {'name': 'Chile'}, {'name': 'Perú'}], filepath)
+
+    # one country removed, another added
+    second = _card_ids([{'name': 'Perú'}, {'name': 'Narnia'}, {'name': 'Cuba'}], filepath)
+    assert second['Cuba'] == first['Cuba']
+    assert second['Perú'] == first['Perú']
+    assert second['Narnia'] not in first.values()
+
+
+def test_card_ids_seeded(tmp_path):
+    db = [{'name': 'Cuba'}, {'name': 'Chile'}]
+    first = _card_ids(db, str(tmp_path / 'one.json'))
+    second = _card_ids([dict(item) for item in db], str(tmp_path / 'other.json'))
+    assert first == second
+
+
+def _fake_rendering(monkeypatch, rendered):
+    """Replace the rendering by writing an empty PDF for each card."""
+    def fake_process(svg_source, result_prefix, name_field, cards, image_info, progress_cb):
+        for card in cards:
+            rendered.append(card['reduced_name'])
+            with open(generate_cards.result_path(result_prefix, card), "wb") as fh:
+                fh.write(b'%PDF')
+    monkeypatch.setattr(generate_cards.templates, 'process', fake_process)
+
+
+def test_renderer_only_changed_cards(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / generate_cards.RESULT_DIR).mkdir()
+    (tmp_path / 'template.svg').write_text("<svg>{{capital}}</svg>")
+    for name in ('cuba', 'chile'):
+        (tmp_path / (name + '.png')).write_bytes(b'image of ' + name.encode())
+    cards = [
+        {'reduced_name': name, 'capital': capital, 'path': name + '.png', 'progress': '1/2'}
+        for name, capital in (('cuba', 'La Habana'), ('chile', 'Santiago'))]
+    image_info = [{'path_variable': 'path'}]
+    rendered = []
+    _fake_rendering(monkeypatch, rendered)
+
+    def render(cards):
+        renderer = generate_cards.Renderer()
+        renderer.process('template.svg', 'result/card', cards, image_info)
+        renderer.finish()
+        done = list(rendered)
+        rendered.clear()
+        return done
+
+    assert render(cards) == ['cuba', 'chile']
+    assert render(cards) == []
+
+    # the progress text is not part of the card's inputs
+    cards[0]['progress'] = '1/3'
+    assert render(cards) == []
+
+    cards[1]['capital'] = 'Santiago de Chile'
+    assert render(cards) == ['chile']
+
+    (tmp_path / 'cuba.png').write_bytes(b'other image')
+    assert render(cards) == ['cuba']
+
+    (tmp_path / 'template.svg').write_text("<svg>Capital: {{capital}}</svg>")
+    assert render(cards) == ['cuba', 'chile']
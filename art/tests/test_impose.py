@@ -0,0 +1,70 @@
+import pypdf
+import pytest
+
+from art import impose
+from art.impose import MM
+
+CARDS = 11
+FRONT_SIZE = (90 * MM, 60 * MM)
+BACK_SIZE = (60 * MM, 90 * MM)
+
+
+def _build_deck(path, size, quantity=CARDS):
+    writer = pypdf.PdfWriter()
+    for _ in range(quantity):
+        writer.add_blank_page(*size)
+    with open(path, "wb") as fh:
+        writer.write(fh)
+    return pypdf.PdfReader(path).pages
+
+
+def _placed_box(layout, idx, page, mirrored):
+    """Return the box (left, bottom, right, top) where the page ends in the sheet."""
+    transformation = impose.placement(layout, idx, page, mirrored=mirrored)
+    box = page.mediabox
+    corners = [
+        transformation.apply_on((float(x), float(y)))
+        for x in (box.left, box.right) for y in (box.bottom, box.top)]
+    xs = [x for x, _ in corners]
+    ys = [y for _, y in corners]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+@pytest.mark.parametrize('paper', sorted(impose.PAPER_SIZES))
+def test_backs_behind_their_fronts(tmp_path, paper):
+    fronts = _build_deck(str(tmp_path / "front.pdf"), FRONT_SIZE)
+    backs = _build_deck(str(tmp_path / "back.pdf"), BACK_SIZE)
+    layout = impose.Layout(impose.PAPER_SIZES[paper], FRONT_SIZE, 3 * MM, 2 * MM)
+
+    for idx in range(layout.per_sheet):
+        front_box = _placed_box(layout, idx, fronts[idx], mirrored=False)
+        back_box = _placed_box(layout, idx, backs[idx], mirrored=True)
+
+        # inside the sheet
+        left, bottom, right, top = back_box
+        assert left >= 0 and bottom >= 0
+        assert right <= layout.width and top <= layout.height
+
+        # when the sheet is flipped (around its vertical axis), it's exactly behind the front
+        flipped = (layout.width - right, bottom, layout.width - left, top)
+        assert flipped == pytest.approx(front_box)
+
+
+def test_impose_sheets(tmp_path):
+    _build_deck(str(tmp_path / "front.pdf"), FRONT_SIZE)
+    _build_deck(str(tmp_path / "back.pdf"), BACK_SIZE)
+    sheets_path = str(tmp_path / "sheets.pdf")
+    layout, sheets = impose.impose(
+        str(tmp_path / "front.pdf"), str(tmp_path / "back.pdf"), sheets_path)
+    assert layout.per_sheet == 9
+    assert sheets == 2
+    assert len(pypdf.PdfReader(sheets_path).pages) == 2 * sheets
+
+
+def test_impose_wrong_back_size(tmp_path):
+    _build_deck(str(tmp_path / "front.pdf"), FRONT_SIZE)
+    _build_deck(str(tmp_path / "back.pdf"), (50 * MM, 90 * MM))
+    with pytest.raises(ValueError):
+        impose.impose(
+            str(tmp_path / "front.pdf"), str(tmp_path / "back.pdf"),
+            str(tmp_path / "sheets.pdf"))
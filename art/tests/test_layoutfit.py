@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from art import layoutfit
+
+ART_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACK_TEMPLATE = os.path.join(ART_DIR, 'card-back-common.svg')
+
+SHORT_FIELDS = {
+    'continent': "América",
+    'capital': "Buenos Aires",
+    'lang_title': "Idioma",
+    'lang_content': "Español",
+    'demonym_title': "Gentilicio",
+    'demonym_content': "Argentino",
+    'codes': "AR / ARG",
+    'original_name': "",
+    'translated_name': "República Argentina",
+    'simple_name': "Argentina",
+}
+
+BROKEN_TEMPLATE = """<svg xmlns="http://www.w3.org/2000/svg">
+  <text id="text1" style="{style}">{{{{capital}}}}</text>
+</svg>
+"""
+
+
+def test_fits_short_texts():
+    assert layoutfit.Layout(BACK_TEMPLATE).fits(SHORT_FIELDS)
+
+
+def test_not_fits_long_texts():
+    fields = dict(SHORT_FIELDS, lang_content="palabra " * 200)
+    assert not layoutfit.Layout(BACK_TEMPLATE).fits(fields)
+
+
+def test_choose_none_fits():
+    fields = dict(SHORT_FIELDS, lang_content="palabra " * 200)
+    candidates = [('first', BACK_TEMPLATE), ('last', BACK_TEMPLATE)]
+    assert layoutfit.choose(fields, candidates) == ('last', False)
+
+
+@pytest.mark.parametrize('style, problem', [
+    ("font-size:3px;font-family:sans-serif;shape-inside:url(#missing)", "not a rectangle"),
+    ("font-family:sans-serif;shape-inside:url(#rect1)", "no font size"),
+    ("font-size:3px;shape-inside:url(#rect1)", "no font family"),
+])
+def test_broken_template(tmp_path, style, problem):
+    svg_source = str(tmp_path / 'broken.svg')
+    with open(svg_source, "wt", encoding="utf8") as fh:
+        fh.write(BROKEN_TEMPLATE.format(style=style).replace(
+            '<text', '<rect id="rect1" x="0" y="0" width="10" height="10"/>\n  <text'))
+    with pytest.raises(ValueError) as cm:
+        layoutfit.Layout(svg_source)
+    assert svg_source in str(cm.value)
+    assert "'text1'" in str(cm.value)
+    assert problem in str(cm.value)
+
+
+def test_font_fallback_warns(capsys):
+    layoutfit.load_font.cache_clear()
+    layoutfit.load_font('Not A Real Family')
+    assert "WARNING! Font for 'Not A Real Family' not found" in capsys.readouterr().out
@@ -0,0 +1,60 @@
+import base64
+import io
+import os
+
+import pytest
+
+from art import rasterizers, templates
+
+ART_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_fetch_local_inside_directory(tmp_path):
+    image_path = tmp_path / "image.png"
+    image_path.write_bytes(b"content")
+    assert rasterizers.fetch_local(str(image_path), 'image/*', str(tmp_path)) == b"content"
+    url = "file://" + str(image_path)
+    assert rasterizers.fetch_local(url, 'image/*', str(tmp_path)) == b"content"
+
+
+def test_fetch_local_data_url(tmp_path):
+    url = "data:image/png;base64," + base64.b64encode(b"content").decode('ascii')
+    assert rasterizers.fetch_local(url, 'image/*', str(tmp_path)) == b"content"
+
+
+def test_fetch_local_outside_directory(tmp_path, capsys):
+    allowed = tmp_path / "allowed"
+    allowed.mkdir()
+    outside = tmp_path / "secret.txt"
+    outside.write_bytes(b"secret")
+    result = rasterizers.fetch_local("file://" + str(outside), 'image/*', str(allowed))
+    assert result == rasterizers.EMPTY_SVG
+    assert "WARNING! Not reading" in capsys.readouterr().out
+
+    # nor escaping through the parent directory
+    url = "file://" + os.path.join(str(allowed), "..", "secret.txt")
+    assert rasterizers.fetch_local(url, 'image/*', str(allowed)) == rasterizers.EMPTY_SVG
+
+
+def test_cairo_renders_card_with_image(tmp_path):
+    try:
+        import cairosvg  # NOQA
+    except (ImportError, OSError) as err:
+        pytest.skip("CairoSVG not available: {}".format(err))
+    from PIL import Image
+
+    flag_path = str(tmp_path / "flag.png")
+    Image.new('RGB', (300, 200), (255, 0, 0)).save(flag_path)
+    image_info = [{
+        'placement_rectangle_id': 'rect19351',
+        'path_variable': 'wflag_path',
+        'placement': 'center',
+    }]
+    template = templates.get_template(os.path.join(ART_DIR, 'card-front.svg'), image_info)
+    content = template.render({
+        'wflag_path': flag_path, 'progress': '', 'reduced_name': 'x', 'idx': '00'})
+
+    rasterizer = rasterizers.CairoRasterizer(dpi=50, files_dir=str(tmp_path))
+    rendered = Image.open(io.BytesIO(rasterizer.render(content.encode('utf8')))).convert('RGB')
+    red_pixels = sum(1 for pixel in rendered.getdata() if pixel == (255, 0, 0))
+    assert red_pixels > rendered.width * rendered.height / 4
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+"""Build everything, running only the steps (see README) whose inputs changed.
+
+Each stage declares the files (or directories) it uses and the ones it produces; after it runs,
+a stamp file keeps a fingerprint of its inputs, so next time it's skipped if they are the same
+and its outputs are still there. Stages that don't depend on each other run concurrently.
+
+At the end, what each stage measured (see `metrics.py`) is put together in a report, with how
+long each stage took.
+
+    ./flagsy.py build                           # build what is needed
+    ./flagsy.py build --force fill_country_info  # run that stage (and what it affects) anyway
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+STAMPS_DIR = os.path.join(BASEDIR, '.build')
+
+# where the stages leave their metrics, and the report of the whole build
+METRICS_DIR = os.path.join(STAMPS_DIR, 'metrics')
+REPORT_PATH = os.path.join(STAMPS_DIR, 'report.json')
+
+# the stages that ended like this let the following ones run
+OK_STATUSES = ('done', 'up to date')
+
+
+class Stage:
+    """A step of the build: a script to run (or a function to call) with its inputs and outputs.
+
+    All paths are relative to the project's root directory.
+    """
+
+    def __init__(self, name, directory, command, inputs, outputs, depends=()):
+        self.name = name
+        self.directory = directory
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.depends = depends
+
+    def run(self):
+        """Run the stage."""
+        if callable(self.command):
+            self.command()
+        else:
+            # run the scripts by themselves, so fades provides their dependencies
+            subprocess.run(
+                self.command, cwd=os.path.join(BASEDIR, self.directory), check=True,
+                env=dict(os.environ, FLAGSY_METRICS_DIR=METRICS_DIR))
+
+
+def copy_to_art():
+    """Move (copy, actually) the metadata and images from raw to art directory."""
+    for name in ('countries_data.json', 'countries_data.sqlite'):
+        shutil.copy2(os.path.join(BASEDIR, 'raw', name), os.path.join(BASEDIR, 'art', name))
+    # the images are links to their blobs (in a hidden subdirectory), copy them as they are
+    shutil.copytree(
+        os.path.join(BASEDIR, 'raw', 'images'), os.path.join(BASEDIR, 'art', 'images'),
+        symlinks=True, dirs_exist_ok=True)
+
+
+STAGES = [
+    Stage(
+        'get_countries_data', 'raw', ['./get_countries_data.py'],
+        inputs=[
+            'raw/get_countries_data.py', 'raw/webcache.py', 'raw/countries_store.py',
+            'metrics.py'],
+        outputs=['raw/countries_data.json', 'raw/countries_data.sqlite']),
+    Stage(
+        'get_coi_data', 'raw', ['./get_coi_data.py', 'download'],
+        inputs=['raw/get_coi_data.py', 'raw/webcache.py', 'raw/searchindex.py', 'metrics.py'],
+        outputs=['raw/coi_data.json', 'raw/coi_index.json']),
+    Stage(
+        'fill_country_info', 'raw', ['./fill_country_info.py', '--workers', '4'],
+        inputs=[
+            'raw/fill_country_info.py', 'raw/webcache.py', 'raw/countries_store.py',
+            'raw/searchindex.py', 'metrics.py', 'raw/countries_data.json', 'raw/coi_data.json'],
+        outputs=['raw/countries_data.json', 'raw/countries_data.sqlite'],
+        depends=['get_countries_data', 'get_coi_data']),
+    Stage(
+        'download_images', 'raw', ['./download_images.py'],
+        inputs=[
+            'raw/download_images.py', 'raw/countries_store.py', 'metrics.py',
+            'raw/countries_data.sqlite'],
+        outputs=['raw/images'],
+        depends=['fill_country_info']),
+    Stage(
+        'copy_to_art', '', copy_to_art,
+        inputs=['raw/countries_data.json', 'raw/countries_data.sqlite', 'raw/images'],
+        outputs=['art/countries_data.json', 'art/countries_data.sqlite', 'art/images'],
+        depends=['download_images']),
+    Stage(
+        'convert_images', 'art', ['./convert_images.py'],
+        inputs=['art/convert_images.py', 'art/rasterizers.py', 'metrics.py', 'art/images'],
+        outputs=['art/pngs'],
+        depends=['copy_to_art']),
+    Stage(
+        'generate_cards', 'art', ['./generate_cards.py', '--deck', '--jobs', str(os.cpu_count())],
+        inputs=[
+            'art/generate_cards.py', 'art/templates.py', 'art/imagecache.py',
+            'art/layoutfit.py', 'art/deck.py', 'art/preview.py', 'art/rasterizers.py',
+            'raw/countries_store.py', 'metrics.py',
+            'art/countries_data.json', 'art/countries_data.sqlite', 'art/pngs',
+            'art/card-front.svg', 'art/card-back-common.svg', 'art/card-back-lang.svg',
+            'art/card-back-dem.svg', 'art/card-back-cntry.svg', 'art/card-back-lang-cntry.svg'],
+        outputs=['final-front.pdf', 'final-back.pdf'],
+        depends=['convert_images']),
+]
+
+
+def fingerprint(path):
+    """Return something that changes if the file (or anything in the directory) changes."""
+    fullpath = os.path.join(BASEDIR, path)
+    if not os.path.exists(fullpath):
+        return None
+    if not os.path.isdir(fullpath):
+        stat = os.stat(fullpath)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    hasher = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(fullpath):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(filepath)
+            except FileNotFoundError:
+                # a broken link
+                continue
+            hasher.update("{}\0{}\0{}\n".format(
+                os.path.relpath(filepath, fullpath), stat.st_mtime_ns, stat.st_size).encode())
+    return hasher.hexdigest()
+
+
+def _stamp_path(stage):
+    """Return the path of the stage's stamp file."""
+    return os.path.join(STAMPS_DIR, stage.name + '.stamp')
+
+
+def is_updated(stage):
+    """Tell if the stage ran with the same inputs than now, and its outputs are there."""
+    if not all(os.path.exists(os.path.join(BASEDIR, path)) for path in stage.outputs):
+        return False
+    try:
+        with open(_stamp_path(stage), "rt", encoding="utf8") as fh:
+            stamp = json.load(fh)
+    except FileNotFoundError:
+        return False
+    return stamp == {path: fingerprint(path) for path in stage.inputs}
+
+
+def save_stamp(stage):
+    """Record the inputs the stage ran with."""
+    # stages finishing at the same time may both create it
+    os.makedirs(STAMPS_DIR, exist_ok=True)
+    stamp_path = _stamp_path(stage)
+    with open(stamp_path + '.tmp', "wt", encoding="utf8") as fh:
+        json.dump({path: fingerprint(path) for path in stage.inputs}, fh, indent=2)
+    os.replace(stamp_path + '.tmp', stamp_path)
+
+
+def _metrics_path(stage):
+    """Return where the stage leaves its metrics."""
+    return os.path.join(METRICS_DIR, stage.name + '.json')
+
+
+def run_stage(stage, force):
+    """Run the stage if needed; return how it went ('done', 'up to date' or 'failed').
+
+    Also return how long it took, and its metrics report if it left one.
+    """
+    if not force and is_updated(stage):
+        print("[{}] up to date".format(stage.name))
+        return 'up to date', 0, None
+
+    missing = [path for path in stage.inputs if fingerprint(path) is None]
+    if missing:
+        print("ERROR: [{}] missing inputs: {}".format(stage.name, ", ".join(missing)))
+        return 'failed', 0, None
+
+    # don't take the metrics of a previous run as of this one
+    if os.path.exists(_metrics_path(stage)):
+        os.remove(_metrics_path(stage))
+
+    print("[{}] running".format(stage.name))
+    tini = time.monotonic()
+    try:
+        stage.run()
+    except Exception as err:
+        print("ERROR: [{}] failed: {}".format(stage.name, err))
+        status = 'failed'
+    else:
+        missing = [path for path in stage.outputs if fingerprint(path) is None]
+        if missing:
+            print("ERROR: [{}] didn't produce: {}".format(stage.name, ", ".join(missing)))
+            status = 'failed'
+        else:
+            save_stamp(stage)
+            status = 'done'
+    duration = time.monotonic() - tini
+    print("[{}] {} in {:.2f}s".format(stage.name, status, duration))
+
+    report = None
+    if os.path.exists(_metrics_path(stage)):
+        with open(_metrics_path(stage), "rt", encoding="utf8") as fh:
+            report = json.load(fh)
+    return status, duration, report
+
+
+def build(stages, jobs=2, force=()):
+    """Run the stages, each one as soon as those it depends on finished.
+
+    Return the result of each stage (see `run_stage`), by name.
+    """
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        unknown = set(stage.depends) - names
+        if unknown:
+            raise ValueError("Stage {!r} depends on unknown {}".format(stage.name, unknown))
+
+    results = {}
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            for stage in list(pending):
+                if not all(name in results for name in stage.depends):
+                    continue
+                pending.remove(stage)
+                if not all(results[name][0] in OK_STATUSES for name in stage.depends):
+                    print("[{}] skipped, as a previous stage failed".format(stage.name))
+                    results[stage.name] = 'skipped', 0, None
+                    continue
+                future = executor.submit(run_stage, stage, 'all' in force or stage.name in force)
+                running[future] = stage
+
+            if not running:
+                if pending:
+                    raise ValueError("Circular dependencies among {}".format(
+                        ", ".join(stage.name for stage in pending)))
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results[running.pop(future).name] = future.result()
+
+    return results
+
+
+def save_report(stages, results, duration):
+    """Save the report of the whole build, and show its summary."""
+    report = {
+        'duration': duration,
+        'stages': {
+            stage.name: dict(zip(('status', 'duration', 'report'), results[stage.name]))
+            for stage in stages if stage.name in results},
+    }
+    if not os.path.exists(STAMPS_DIR):
+        os.mkdir(STAMPS_DIR)
+    with open(REPORT_PATH + '.tmp', "wt", encoding="utf8") as fh:
+        json.dump(report, fh, indent=2)
+    os.replace(REPORT_PATH + '.tmp', REPORT_PATH)
+
+    print()
+    print("{:20s} {:>10s} {:>9s}".format("stage", "status", "time(s)"))
+    for name, stage_result in report['stages'].items():
+        print("{:20s} {:>10s} {:9.2f}".format(
+            name, stage_result['status'], stage_result['duration']))
+    stage_reports = [stage_result['report'] for stage_result in report['stages'].values()]
+    stage_reports = [stage_report for stage_report in stage_reports if stage_report]
+    if stage_reports:
+        print()
+        print(metrics.format_table(stage_reports))
+    print("Total {:.2f}s, report saved in {!r}".format(duration, REPORT_PATH))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help="Build what is needed (see README).")
+    build_parser.add_argument(
+        '--force', action='append', default=[], choices=['all'] + [s.name for s in STAGES],
+        help="Run the stage even if up to date (can be repeated; 'all' for everything).")
+    build_parser.add_argument(
+        '-j', '--jobs', type=int, default=2, help="How many stages to run at the same time.")
+    args = parser.parse_args()
+
+    tini = time.monotonic()
+    results = build(STAGES, jobs=args.jobs, force=args.force)
+    save_report(STAGES, results, time.monotonic() - tini)
+    ok = all(status in OK_STATUSES for status, _, _ in results.values())
+    sys.exit(0 if ok else 1)
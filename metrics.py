@@ -0,0 +1,165 @@
+"""Measure what each step of the build does, to know where the time goes.
+
+The scripts record events (an HTTP request, the parsing of a country's page, the conversion of
+an image, the rendering of a card...) with their duration and some details, like the country
+they belong to; at the end of the run `save_report` writes all of them in a JSON file, with the
+totals for each kind of event and for each country, and prints a summary table.
+
+The reports are left in the `.metrics` directory (or where FLAGSY_METRICS_DIR says), one per
+step; `flagsy.py build` collects all of them in a single report.
+
+This module is linked from the `raw` and `art` directories, so the scripts there import it as
+any of their other helpers.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+REPORT_DIR = os.environ.get('FLAGSY_METRICS_DIR', '.metrics')
+
+# how many countries to show in the summary, the ones that took longer
+SLOWEST_COUNTRIES = 5
+
+_events = []
+_lock = threading.Lock()
+_started = time.time()
+_country = contextvars.ContextVar('country', default=None)
+
+
+def record(kind, duration, **details):
+    """Record an event that took that duration (in seconds), for the current country if any."""
+    event = {'kind': kind, 'duration': duration}
+    country = _country.get()
+    if country is not None:
+        event['country'] = country
+    event.update(details)
+    with _lock:
+        _events.append(event)
+
+
+@contextlib.contextmanager
+def measure(kind, **details):
+    """Record an event with the duration of the block; it can add details to the given dict."""
+    tini = time.monotonic()
+    try:
+        yield details
+    finally:
+        record(kind, time.monotonic() - tini, **details)
+
+
+@contextlib.contextmanager
+def for_country(country):
+    """Assign the events recorded in the block (in this thread) to the country."""
+    token = _country.set(country)
+    try:
+        yield
+    finally:
+        _country.reset(token)
+
+
+def reset():
+    """Forget all the events (e.g. those inherited by a forked process)."""
+    with _lock:
+        _events.clear()
+
+
+def pop_events():
+    """Return the events recorded so far, forgetting them (to be merged in other process)."""
+    with _lock:
+        events = list(_events)
+        _events.clear()
+    return events
+
+
+def extend(events):
+    """Add events recorded somewhere else."""
+    with _lock:
+        _events.extend(events)
+
+
+def summarize(events):
+    """Aggregate the events of each kind: quantity, durations, and bytes and cache use if any."""
+    summary = {}
+    for event in events:
+        totals = summary.setdefault(event['kind'], {'count': 0, 'total': 0.0, 'max': 0.0})
+        totals['count'] += 1
+        totals['total'] += event['duration']
+        totals['max'] = max(totals['max'], event['duration'])
+        if 'bytes' in event:
+            totals['bytes'] = totals.get('bytes', 0) + event['bytes']
+        if 'cache' in event:
+            cache = totals.setdefault('cache', {})
+            cache[event['cache']] = cache.get(event['cache'], 0) + 1
+    for totals in summary.values():
+        totals['mean'] = totals['total'] / totals['count']
+    return summary
+
+
+def build_report(stage, events, duration):
+    """Build the report of the step, with all the events and their summaries."""
+    by_country = defaultdict(list)
+    for event in events:
+        if 'country' in event:
+            by_country[event['country']].append(event)
+    return {
+        'stage': stage,
+        'duration': duration,
+        'summary': summarize(events),
+        'countries': {country: summarize(evs) for country, evs in sorted(by_country.items())},
+        'events': events,
+    }
+
+
+def format_table(reports):
+    """Build a table with the summary of each kind of event of each report."""
+    rows = []
+    for report in reports:
+        for kind, totals in sorted(report['summary'].items()):
+            kbytes = "{:.1f}".format(totals['bytes'] / 1024) if 'bytes' in totals else "-"
+            cache = " ".join(
+                "{}:{}".format(*item) for item in sorted(totals.get('cache', {}).items()))
+            rows.append((
+                report['stage'], kind, str(totals['count']), "{:.2f}".format(totals['total']),
+                "{:.1f}".format(totals['mean'] * 1000), "{:.1f}".format(totals['max'] * 1000),
+                kbytes, cache or "-"))
+
+    # the texts are left aligned and the numbers right aligned, all columns as wide as needed
+    header = ("stage", "kind", "count", "total(s)", "mean(ms)", "max(ms)", "KB", "cache")
+    widths = [max(len(row[idx]) for row in [header] + rows) for idx in range(len(header))]
+    lines = []
+    for row in [header] + rows:
+        cells = [
+            value.ljust(width) if idx in (0, 1, 7) else value.rjust(width)
+            for idx, (value, width) in enumerate(zip(row, widths))]
+        lines.append("  ".join(cells).rstrip())
+
+    countries = defaultdict(float)
+    for report in reports:
+        for country, summary in report['countries'].items():
+            countries[country] += sum(totals['total'] for totals in summary.values())
+    slowest = sorted(countries.items(), key=lambda item: item[1], reverse=True)
+    if slowest:
+        lines.append("Slowest countries: " + ", ".join(
+            "{} ({:.2f}s)".format(*item) for item in slowest[:SLOWEST_COUNTRIES]))
+    return "\n".join(lines)
+
+
+def save_report(stage):
+    """Save the report of all that was recorded in the run, and show its summary."""
+    report = build_report(stage, pop_events(), time.time() - _started)
+    if not os.path.exists(REPORT_DIR):
+        os.makedirs(REPORT_DIR, exist_ok=True)
+    report_path = os.path.join(REPORT_DIR, stage + '.json')
+    with open(report_path + '.tmp', "wt", encoding="utf8") as fh:
+        json.dump(report, fh, indent=2)
+    os.replace(report_path + '.tmp', report_path)
+
+    if report['summary']:
+        print(format_table([report]))
+    print("Metrics saved in {!r}".format(report_path))
+    return report_path
@@ -0,0 +1,192 @@
+"""An SQLite store for the countries data, where each record is saved as soon as it changes.
+
+Records are kept as JSON (as always), indexed by name, url, code and processed status, and
+can be exported to the JSON and CSV formats used by the rest of the project.
+
+Some fields are not got from anywhere but set by hand in the JSON file (see HAND_FIELDS); they
+are kept when the file is exported again, and used over what the store has when loading it.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import threading
+
+STORE_FILEPATH = 'countries_data.sqlite'
+
+PROCESSED_FLAG = "__processed__"
+PROCESSED_OK = 'ok'
+
+# the fields (in order) of the exported CSV
+CSV_FIELDS = [
+    'name', 'url', 'continent', 'name_translated', 'name_original', 'capital_name',
+    'languages', 'demonyms', 'flag_url', 'world_location_url', 'code',
+]
+
+# the fields that are edited by hand in the JSON file
+HAND_FIELDS = ['style']
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS countries (
+        position INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        url TEXT NOT NULL UNIQUE,
+        code TEXT,
+        processed TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS countries_code ON countries (code);
+    CREATE INDEX IF NOT EXISTS countries_processed ON countries (processed);
+"""
+
+
+class CountryStore:
+    """The store itself, safe to be used from several threads."""
+
+    def __init__(self, filepath=STORE_FILEPATH):
+        self.filepath = filepath
+        self._conn = sqlite3.connect(filepath, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        """Close the store."""
+        self._conn.close()
+
+    def _query(self, sql, params=()):
+        """Run a query and return the items from the found rows."""
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def is_empty(self):
+        """Tell if the store has no records at all."""
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM countries").fetchone()
+        return count == 0
+
+    def load(self, only_processed_ok=False):
+        """Return all the items, in their original order."""
+        if only_processed_ok:
+            return self._query(
+                "SELECT data FROM countries WHERE processed = ? ORDER BY position",
+                (PROCESSED_OK,))
+        return self._query("SELECT data FROM countries ORDER BY position")
+
+    def get(self, name=None, url=None, code=None):
+        """Get an item by its name, url or code; None if not there."""
+        for column, value in (('name', name), ('url', url), ('code', code)):
+            if value is not None:
+                break
+        else:
+            raise ValueError("Need a name, url or code to search for.")
+        found = self._query("SELECT data FROM countries WHERE {} = ?".format(column), (value,))
+        return found[0] if found else None
+
+    def _update(self, item):
+        """Update the row of the item with its data; the lock must be already held."""
+        self._conn.execute(
+            "UPDATE countries SET name = ?, code = ?, processed = ?, data = ? WHERE url = ?",
+            (item['name'], item.get('code'), item.get(PROCESSED_FLAG), json.dumps(item),
+             item['url']))
+
+    def save(self, item):
+        """Save an item (that must be already in the store), committing it immediately."""
+        with self._lock, self._conn:
+            self._update(item)
+
+    def merge(self, items):
+        """Add the new items; for those already in the store, update the given fields."""
+        with self._lock, self._conn:
+            for item in items:
+                row = self._conn.execute(
+                    "SELECT data FROM countries WHERE url = ?", (item['url'],)).fetchone()
+                if row is None:
+                    self._conn.execute(
+                        "INSERT INTO countries (name, url, code, processed, data) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (item['name'], item['url'], item.get('code'), item.get(PROCESSED_FLAG),
+                         json.dumps(item)))
+                else:
+                    stored = json.loads(row[0])
+                    stored.update(item)
+                    self._update(stored)
+
+    def import_json(self, filepath):
+        """Merge the items of a JSON file with all the countries data."""
+        with open(filepath, "rt", encoding="utf8") as fh:
+            self.merge(json.load(fh))
+
+    def export_json(self, filepath):
+        """Export all the items to a JSON file as used by the scripts, keeping the hand edits."""
+        items = merge_hand_fields(self.load(), filepath)
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, "wt", encoding="ascii") as fh:
+            json.dump(items, fh)
+        os.replace(tmp_filepath, filepath)
+
+    def export_csv(self, filepath):
+        """Export the processed items to a CSV file."""
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, "wt", encoding="utf8", newline='') as fh:
+            writer = csv.DictWriter(fh, CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(self.load(only_processed_ok=True))
+        os.replace(tmp_filepath, filepath)
+
+
+def merge_hand_fields(items, json_filepath):
+    """Set in the items the fields edited by hand in the JSON file (if it's there)."""
+    if not os.path.exists(json_filepath):
+        return items
+    with open(json_filepath, "rt", encoding="ascii") as fh:
+        hand_set = {
+            item['url']: {field: item[field] for field in HAND_FIELDS if field in item}
+            for item in json.load(fh)}
+    for item in items:
+        item.update(hand_set.get(item['url'], {}))
+    return items
+
+
+def load_db(json_filepath, store_filepath=STORE_FILEPATH, only_processed_ok=False):
+    """Load the countries data from the store if present, else from the JSON file.
+
+    When loading from the store, the fields edited by hand in the JSON file are used.
+    """
+    if os.path.exists(store_filepath):
+        store = CountryStore(store_filepath)
+        try:
+            items = store.load(only_processed_ok=only_processed_ok)
+        finally:
+            store.close()
+        return merge_hand_fields(items, json_filepath)
+
+    with open(json_filepath, "rt", encoding="ascii") as fh:
+        db = json.load(fh)
+    if only_processed_ok:
+        db = [item for item in db if item.get(PROCESSED_FLAG) == PROCESSED_OK]
+    return db
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the countries data from the store (or import a JSON file in it).")
+    parser.add_argument('format', choices=['json', 'csv', 'import'])
+    parser.add_argument('filepath')
+    args = parser.parse_args()
+
+    if not os.path.exists(STORE_FILEPATH):
+        print("ERROR: Missing needed file {!r} -- Please check README.".format(STORE_FILEPATH))
+        exit()
+
+    store = CountryStore()
+    if args.format == 'import':
+        store.import_json(args.filepath)
+    elif args.format == 'json':
+        store.export_json(args.filepath)
+    else:
+        store.export_csv(args.filepath)
+    store.close()
@@ -1,14 +1,56 @@
 #!/usr/bin/env fades
 
+import argparse
+import glob
+import hashlib
 import json
 import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests  # fades
 
-PROCESSED_FLAG = "__processed__"
-PROCESSED_OK = 'ok'
+import metrics
+from countries_store import load_db
+
 DOWNLOAD_DIR = 'images'
 
+# inside the download directory (hidden, so the images are still alone in the directory)
+BLOBS_DIR = '.blobs'
+MANIFEST_FILENAME = '.manifest.json'
+
+# partial downloads live in the same directory (so they can be renamed atomically) with this
+TEMP_PREFIX = '.downloading-'
+
+CHUNK_SIZE = 64 * 1024
+
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=32))
+
+
+class Progress:
+    """Keep and show the progress of all the downloads together."""
+
+    def __init__(self, total_items):
+        self.total_items = total_items
+        self.done_items = 0
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+
+    def add_bytes(self, quantity):
+        """Some bytes were downloaded."""
+        with self._lock:
+            self.total_bytes += quantity
+
+    def item_done(self, message):
+        """An item finished (in any way), show it with the general progress."""
+        with self._lock:
+            self.done_items += 1
+            print(" {:5d}/{}  {:8.1f} KB  {}".format(
+                self.done_items, self.total_items, self.total_bytes / 1024, message))
+
 
 def build_name(name, imgtype, url):
     """Build a name using components."""
@@ -19,26 +61,143 @@ def build_name(name, imgtype, url):
     return os.path.join(DOWNLOAD_DIR, fname)
 
 
-def download(url, destpath):
-    """Download the images (all small files, no need to complicate this)."""
-    if os.path.exists(destpath):
-        print("    skipping", repr(destpath))
-        return
+class ImageStore:
+    """Store the images by content, remembering what was downloaded from each url.
+
+    Each distinct content is stored once as a blob named by its SHA-256, and a manifest keeps
+    for each url its blob and the validators (ETag, Last-Modified) to check later if the image
+    changed in the server.
+    """
+
+    def __init__(self, directory):
+        self.blobs_dir = os.path.join(directory, BLOBS_DIR)
+        self.manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+        self._lock = threading.Lock()
+        if not os.path.exists(self.blobs_dir):
+            os.mkdir(self.blobs_dir)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "rt", encoding="utf8") as fh:
+                self.manifest = json.load(fh)
+        else:
+            self.manifest = {}
+
+    def save_manifest(self):
+        """Save the manifest atomically."""
+        with self._lock:
+            temp_path = self.manifest_path + '.tmp'
+            with open(temp_path, "wt", encoding="utf8") as fh:
+                json.dump(self.manifest, fh, indent=2, sort_keys=True)
+            os.replace(temp_path, self.manifest_path)
 
-    print("    downloading {!r} to {!r}".format(url, destpath))
-    resp = requests.get(url)
-    if resp.status_code != 200:
-        print("    ERROR! got {}", resp.status_code)
+    def blob_path(self, entry):
+        """Return the path of the blob for a manifest entry."""
+        return os.path.join(self.blobs_dir, "{}.{}".format(entry['sha256'], entry['ext']))
+
+    def fetch(self, url, progress, details=None):
+        """Get the blob for the url, only downloading it if new or changed in the server.
+
+        Return the blob's path, or None if it couldn't be get. How it went is left in the
+        details dict, if given (for the metrics).
+        """
+        if details is None:
+            details = {}
+        entry = self.manifest.get(url)
+        headers = {}
+        if entry is not None and os.path.exists(self.blob_path(entry)):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            resp = session.get(url, headers=headers, stream=True)
+        except requests.RequestException as err:
+            progress.item_done("ERROR! failed downloading {!r}: {}".format(url, err))
+            return
+        details['status'] = resp.status_code
+        if resp.status_code == 304:
+            details['cache'] = 'revalidated'
+            resp.close()
+            progress.item_done("not changed {!r}".format(url))
+            return self.blob_path(entry)
+        if resp.status_code != 200:
+            resp.close()
+            progress.item_done("ERROR! got {} for {!r}".format(resp.status_code, url))
+            return
+
+        fd, temp_path = tempfile.mkstemp(dir=self.blobs_dir, prefix=TEMP_PREFIX)
+        try:
+            size = 0
+            hasher = hashlib.sha256()
+            with os.fdopen(fd, "wb") as fh:
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    fh.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    progress.add_bytes(len(chunk))
+
+            # if the content was not encoded, the length must match exactly
+            expected = resp.headers.get('Content-Length')
+            if expected is not None and 'Content-Encoding' not in resp.headers:
+                if int(expected) != size:
+                    raise ValueError(
+                        "Incomplete download: got {} bytes of {}".format(size, expected))
+        except Exception as err:
+            os.remove(temp_path)
+            progress.item_done("ERROR! failed downloading {!r}: {}".format(url, err))
+            return
+        finally:
+            resp.close()
+        details['cache'] = 'miss'
+        details['bytes'] = size
+
+        new_entry = {
+            'sha256': hasher.hexdigest(),
+            'ext': url.split('.')[-1],
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+        }
+        blob_path = self.blob_path(new_entry)
+        if os.path.exists(blob_path):
+            # same content than other url (or than before), no need to keep it twice
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, blob_path)
+        with self._lock:
+            self.manifest[url] = new_entry
+        progress.item_done("downloaded {!r}".format(url))
+        return blob_path
+
+
+def link(blob_path, destpath):
+    """Make the destination point to the blob, atomically."""
+    relative = os.path.relpath(blob_path, os.path.dirname(destpath))
+    if os.path.islink(destpath) and os.readlink(destpath) == relative:
         return
+    temp_path = os.path.join(os.path.dirname(destpath), TEMP_PREFIX + os.path.basename(destpath))
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    os.symlink(relative, temp_path)
+    os.replace(temp_path, destpath)
+
+
+def download(store, url, destpaths, progress, country):
+    """Download the image once (if changed) and link it from all the destinations.
 
-    with open(destpath, "wb") as fh:
-        fh.write(resp.content)
+    Return if it could be done.
+    """
+    with metrics.for_country(country), metrics.measure('http', url=url, bytes=0) as details:
+        blob_path = store.fetch(url, progress, details)
+    if blob_path is None:
+        return False
+    for destpath in destpaths:
+        link(blob_path, destpath)
+    return True
 
 
-def main(main_filepath):
-    """Main entry point."""
-    with open(main_filepath, "rt", encoding="ascii") as fh:
-        main_db = json.load(fh)
+def main(main_filepath, workers=1):
+    """Main entry point; return the urls that couldn't be downloaded."""
+    main_db = load_db(main_filepath, only_processed_ok=True)
 
     tot_items = len(main_db)
     if len(set(item['name'] for item in main_db)) != tot_items:
@@ -49,26 +208,68 @@ def main(main_filepath):
     if not os.path.exists(DOWNLOAD_DIR):
         os.mkdir(DOWNLOAD_DIR)
 
-    for idx, item in enumerate(main_db, 1):
-        if item[PROCESSED_FLAG] != PROCESSED_OK:
-            continue
+    store = ImageStore(DOWNLOAD_DIR)
 
-        print(" {:5d}/{}  {}".format(idx, tot_items, item['name']))
+    # remove leftovers of previous interrupted runs
+    for directory in (DOWNLOAD_DIR, store.blobs_dir):
+        for temp_path in glob.glob(os.path.join(directory, TEMP_PREFIX + '*')):
+            os.remove(temp_path)
+
+    # the same image may be used for several items, download it once (in the metrics, it
+    # counts for the first country using it)
+    to_download = {}
+    countries = {}
+    for item in main_db:
         name = item['name']
         flag_url = item['flag_url']
         wloc_url = item['world_location_url']
 
-        download(flag_url, build_name(name, 'flag', flag_url))
-        download(wloc_url, build_name(name, 'location', wloc_url))
+        to_download.setdefault(flag_url, []).append(build_name(name, 'flag', flag_url))
+        to_download.setdefault(wloc_url, []).append(build_name(name, 'location', wloc_url))
+        countries.setdefault(flag_url, name)
+        countries.setdefault(wloc_url, name)
+
+    progress = Progress(len(to_download))
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(download, store, url, destpaths, progress, countries[url]): url
+                for url, destpaths in to_download.items()}
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    ok = future.result()
+                except Exception as err:
+                    print("ERROR: failed storing {!r}: {!r}".format(url, err))
+                    ok = False
+                if not ok:
+                    failed.append(url)
+    finally:
+        store.save_manifest()
+        metrics.save_report('download_images')
 
-    print("Done")
+    if failed:
+        print("ERROR: {} images couldn't be downloaded:".format(len(failed)))
+        for url in sorted(failed):
+            print("   ", url)
+    else:
+        print("Done")
+    return failed
 
 
 if __name__ == "__main__":
     main_db_filepath = 'countries_data.json'
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--workers', type=int, default=8, help="How many images to download concurrently.")
+    args = parser.parse_args()
+
     if not os.path.exists(main_db_filepath):
         print("ERROR: Missing needed file {!r} -- Please check README.".format(main_db_filepath))
         exit()
 
-    main(main_db_filepath)
+    failed = main(main_db_filepath, workers=args.workers)
+    if failed:
+        sys.exit(1)
@@ -1,18 +1,29 @@
 #!/usr/bin/env fades
 
+import argparse
 import json
 import os
 import re
-import shutil
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from difflib import SequenceMatcher
 from pprint import pprint  # NOQA (commented out by default)
 from urllib import parse
 
 import requests  # fades
 
+import metrics
+import webcache
+from countries_store import CountryStore
+from searchindex import SearchIndex
+
 
 PROCESSED_FLAG = "__processed__"
 PROCESSED_IGNORE = 'ignore'
 PROCESSED_OK = 'ok'
+REVISION_ID = "revid"
 IMAGES_CONTAINER = "__images__"
 
 IMAGE_QUERY_URL = (
@@ -20,23 +31,45 @@ IMAGE_QUERY_URL = (
     "&prop=imageinfo"  # getting the image info...
     "&iiprop=url"  # ...specifically the url
     "&format=json"  # return response in json
-    "&titles=File:{filename}"  # the filename of which we want the url
+    "&maxlag={maxlag}"  # let the servers tell us to slow down if they are lagged
+    "&titles={titles}"  # the files (with their 'File:' prefix) of which we want the url
 )
 
 COUNTRY_INFO_URL = (
     "https://es.wikipedia.org/w/api.php?action=query"  # base query
     "&prop=revisions"  # get info for each revision (default latest)...
-    "&rvprop=content&rvsection=0&rvslots=main"  # ...specifically the content, main section
+    "&rvprop=content|ids&rvsection=0&rvslots=main"  # ...the content (main section) and its id
+    "&format=json"  # return response in json
+    "&maxlag={maxlag}"  # let the servers tell us to slow down if they are lagged
+    "&redirects=1"  # follow redirects, we get them mapped in the response
+    "&titles={titles}"  # the countries of which we want the info
+)
+
+LAST_REVISION_URL = (
+    "https://es.wikipedia.org/w/api.php?action=query"  # base query
+    "&prop=info"  # get the basic page info, which includes the last revision id
     "&format=json"  # return response in json
-    "&titles={country}"  # the country of which we want the info
+    "&maxlag={maxlag}"  # let the servers tell us to slow down if they are lagged
+    "&redirects=1"  # follow redirects, we get them mapped in the response
+    "&titles={titles}"  # the countries of which we want the info
 )
 
+# the API accepts up to this quantity of titles in the same query
+BATCH_SIZE = 50
+
+# seconds of replication lag after which Wikimedia servers refuse our requests
+MAXLAG = 5
+
+# how many times a request is retried after the server asked us to slow down
+MAX_RETRIES = 5
+
 # some info is simply wrong in Wikipedia, we overrule that here
 OVERRULE = {
     'Comoras': {'código_ISO': "KM / COM / 174"},
 }
 
-# COI data is weird
+# COI data is weird; the countries not found are reported with the most similar COI names,
+# add here the right one (a similar name may be a different country)
 COI_TRANSLATIONS = {
     'Reino Unido': 'Gran Bretaña',
     'Ciudad del Vaticano': None,
@@ -44,10 +77,11 @@ COI_TRANSLATIONS = {
 
 # some regexes
 RE_BR = re.compile(r"<br(?: )?(?:/)?>")
-RE_REDUX = re.compile(r"""
-    [\{\[]{2}    # start with a double { or [
-    ([^{^\[]*?)  # get anything unless we detect the beginning of other enclosing
-    [\}\]]{2}    # until a double } or ]
+RE_MARKUP = re.compile(r"""
+    \{\{ | \[\[     # the beginning of a template or link
+    | \}\} | \]\]   # the end of any of them
+    | <!--          # the beginning of a comment
+    | <ref[\s>/]    # the beginning of a reference (but not of '<references')
 """, re.VERBOSE)
 
 
@@ -55,6 +89,80 @@ class SkipError(Exception):
     """Flags to skip it."""
 
 
+class RateLimiter:
+    """Space the requests of all the workers, slowing down when the server asks for it."""
+
+    def __init__(self, max_delay=60):
+        self.max_delay = max_delay
+        self.delay = 0
+        self._next_request = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until it's our turn to hit the server."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_request)
+            self._next_request = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+    def backoff(self, retry_after):
+        """The server complained, make everybody wait and increase the delay between requests."""
+        with self._lock:
+            self.delay = min(max(self.delay * 2, 0.1), self.max_delay)
+            self._next_request = max(self._next_request, time.monotonic() + retry_after)
+
+    def relax(self):
+        """A request went fine, slowly go back to full speed."""
+        with self._lock:
+            self.delay = self.delay * 0.9 if self.delay > 0.01 else 0
+
+
+rate_limiter = RateLimiter()
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=32))
+
+
+def _get_retry_after(resp):
+    """Get how many seconds the server wants us to wait (if it's not a number, just guess)."""
+    try:
+        return float(resp.headers.get('Retry-After', 1))
+    except ValueError:
+        return 1
+
+
+def _throttled_get(url, headers):
+    """Hit the server, but only when it's our turn."""
+    rate_limiter.wait()
+    return session.get(url, headers=headers)
+
+
+def get_json(url, max_age=None):
+    """Get the JSON response from the url, respecting the server's requests to slow down.
+
+    Responses are cached, `max_age` can be used to avoid older ones (0 to always hit the server).
+    """
+    for _ in range(MAX_RETRIES):
+        resp = webcache.get(url, fetch=_throttled_get, max_age=max_age)
+        if resp.status_code in (429, 503):
+            lagged = True
+        else:
+            data = json.loads(resp.text)
+            lagged = data.get('error', {}).get('code') == 'maxlag'
+        if not lagged:
+            if not resp.from_cache:
+                rate_limiter.relax()
+            return data
+
+        # don't keep the complaint as a valid response
+        webcache.forget(url)
+        retry_after = _get_retry_after(resp)
+        print("    server asked to slow down, waiting {} seconds".format(retry_after))
+        rate_limiter.backoff(retry_after)
+    raise ValueError("Server still lagged after {} retries: {}".format(MAX_RETRIES, url))
+
+
 def parse_image_url(data):
     """Parse image data and get the url."""
     (page,) = data['query']['pages'].values()
@@ -62,23 +170,65 @@ def parse_image_url(data):
     return info['url']
 
 
-def get_image_url(filename):
-    """Get the image url from the filename."""
-    query_url = IMAGE_QUERY_URL.format(filename=parse.quote(filename))
-    resp = requests.get(query_url)
-    data = json.loads(resp.text)
-    try:
-        image_url = parse_image_url(data)
-    except Exception:
-        print("ERROR: crashed while processing stuff from", query_url)
-        raise
-    return image_url
+def _merge_pages(pages, new_pages):
+    """Merge the info of pages that came in a continuation of a previous query."""
+    for pageid, new_page in new_pages.items():
+        page = pages.setdefault(pageid, new_page)
+        for key, value in new_page.items():
+            if isinstance(value, list) and key in page and page[key] is not value:
+                page[key].extend(value)
+            else:
+                page.setdefault(key, value)
+
+
+def _resolve_title(query, title):
+    """Follow the normalizations and redirects the server did on the requested title."""
+    mapping = {}
+    for item in query.get('normalized', []) + query.get('redirects', []):
+        mapping[item['from']] = item['to']
+
+    seen = set()
+    while title in mapping and title not in seen:
+        seen.add(title)
+        title = mapping[title]
+    return title
+
+
+def get_pages(url_template, titles, max_age=None):
+    """Get many pages, in batches, returning the data for each one as if queried alone.
+
+    The result is a dict with the titles as requested (before any normalization or redirection
+    done by the server) as keys, and the data for that page as value; missing pages are None.
+    """
+    titles = list(titles)
+    result = {}
+    for pos in range(0, len(titles), BATCH_SIZE):
+        batch = titles[pos:pos + BATCH_SIZE]
+        query_url = url_template.format(titles=parse.quote('|'.join(batch)), maxlag=MAXLAG)
+        data = get_json(query_url, max_age=max_age)
+        query = data['query']
+        pages = query['pages']
+
+        # the server may cut the results, continue asking until it's complete
+        while 'continue' in data:
+            continue_params = parse.urlencode(data['continue'])
+            data = get_json(query_url + '&' + continue_params, max_age=max_age)
+            _merge_pages(pages, data['query']['pages'])
+
+        by_title = {page['title']: page for page in pages.values() if 'missing' not in page}
+        for title in batch:
+            page = by_title.get(_resolve_title(query, title))
+            if page is None:
+                print("ERROR: page not found for {!r} in {}".format(title, query_url))
+                result[title] = None
+            else:
+                result[title] = {'query': {'pages': {str(page.get('pageid')): page}}}
+    return result
 
 
-def extract_payload(m):
+def extract_payload(payload):
     """Extract the inner payload in a typical well formed preprocessor, if payload is there."""
     debug = False
-    (payload,) = m.groups()
     if '|' not in payload:
         # simplest string, use that
         if debug:
@@ -131,6 +281,72 @@ def simplify(text, debug=False):
     return text
 
 
+def _skip_reference(rawinfo, pos):
+    """Return the position after the reference that starts in `pos`."""
+    tag_end = rawinfo.find('>', pos)
+    if tag_end == -1:
+        return len(rawinfo)
+    if rawinfo[tag_end - 1] == '/':
+        # self closing reference, just the tag
+        return tag_end + 1
+    ref_end = rawinfo.find('</ref>', tag_end)
+    return len(rawinfo) if ref_end == -1 else ref_end + len('</ref>')
+
+
+def reduce_markup(rawinfo):
+    """Reduce the internal markup structures, in a single pass.
+
+    Nested templates and links are replaced (from the innermost out) by their useful payload,
+    while references and comments are just removed.
+    """
+    # the pieces of each structure that is open at the moment (the first item holds the
+    # text outside all of them) and the opening markers of those structures
+    stack = [[]]
+    openers = []
+    pos = 0
+    while True:
+        m = RE_MARKUP.search(rawinfo, pos)
+        if m is None:
+            stack[-1].append(rawinfo[pos:])
+            break
+        stack[-1].append(rawinfo[pos:m.start()])
+        token = m.group()
+        pos = m.end()
+
+        if token in ('{{', '[['):
+            stack.append([])
+            openers.append(token)
+        elif token in ('}}', ']]'):
+            if openers:
+                openers.pop()
+                payload = ''.join(stack.pop())
+                stack[-1].append(extract_payload(payload))
+            else:
+                # closing something never opened, leave it there
+                stack[-1].append(token)
+        elif token == '<!--':
+            comment_end = rawinfo.find('-->', pos)
+            pos = len(rawinfo) if comment_end == -1 else comment_end + len('-->')
+        else:
+            pos = _skip_reference(rawinfo, m.start())
+
+    # structures never closed are left as they were
+    while openers:
+        payload = ''.join(stack.pop())
+        stack[-1].append(openers.pop() + payload)
+    return ''.join(stack[0])
+
+
+def parse_elements(reduced):
+    """Split the fields of the (already reduced) info and build a dict with their values."""
+    elements = {}
+    for field in reduced.split('|'):
+        key, equal, value = field.partition('=')
+        if equal:
+            elements[key.strip()] = value.strip()
+    return elements
+
+
 class CountryInfo:
     def __init__(self, country, data):
         self.overrule = OVERRULE.get(country, {})
@@ -148,29 +364,7 @@ class CountryInfo:
         # print("======== rawinfo", repr(rawinfo))
         # import pdb;pdb.set_trace()
 
-        # reduce the internal markup structures
-        while True:
-            reduced = RE_REDUX.sub(extract_payload, rawinfo)
-            # print("======== reduced", repr(reduced))
-            if reduced == rawinfo:
-                break
-            rawinfo = reduced
-
-        # Remove spurious \n between titles and their values
-        reduced = re.sub(r'\| *?(\w+) *?\n *?=', lambda m: '|' + m.groups()[0] + '=', reduced)
-        # Remove htmlish references and comments
-        reduced = re.sub(r'<ref[^>]*>.*?</ref>', '', reduced)
-        reduced = re.sub(r'<ref .*?/>', '', reduced)
-        reduced = re.sub(r'<!--.*?-->', '', reduced)
-        # print("======== postproc", repr(reduced))
-
-        # Split elements, and build dicts using titles/values.
-        # the identifier until the equal sign as key
-        elements = [x.strip() for x in reduced.split('|')]
-        elements = [x.split('=', 1) for x in elements if '=' in x]
-        elements = {k.strip(): v.strip() for k, v in elements}
-        # print("======== elements", pprint(elements))
-        self.elements = elements
+        self.elements = parse_elements(reduce_markup(rawinfo))
 
     def has(self, key):
         """Check if has the key."""
@@ -238,82 +432,148 @@ def parse_country_info(country, data):
     return result
 
 
-def process(full_url):
-    """Process each country's page and get extra info."""
-    country = full_url.split('/')[-1]
-    query_url = COUNTRY_INFO_URL.format(country=country)
-    resp = requests.get(query_url)
-    data = json.loads(resp.text)
-    try:
-        country_info = parse_country_info(country, data)
-    except Exception:
-        print("ERROR: crashed while processing stuff from", query_url)
-        raise
-    return country_info
+def normalize_name(name):
+    """Normalize a name to compare it: no case, accents, underscores, spaces or punctuation."""
+    name = unicodedata.normalize('NFKD', parse.unquote(name).casefold())
+    return ''.join(char for char in name if char.isalnum())
 
 
-def get_coi(coi_db, url, name):
-    """Try to find the COI from the url or name."""
-    to_search = set()
+class CoiIndex(dict):
+    """The COI codes by normalized name, with a search index for when there is no exact match."""
+
+    def __init__(self, coi_db):
+        super().__init__()
+        for name, code in coi_db.items():
+            self.setdefault(normalize_name(name), code)
+        self.search_index = SearchIndex((name, code, '') for name, code in self.items())
+
+
+def build_coi_index(coi_db):
+    """Build an index of the COI codes by normalized name."""
+    return CoiIndex(coi_db)
+
 
-    # from the url
-    url_name = url.split('/')[-1]
-    to_search.add(url_name)
-    to_search.add(parse.quote(url_name))
-    to_search.add(parse.unquote(url_name))
+_NORMALIZED_COI_TRANSLATIONS = {
+    normalize_name(name): None if translated is None else normalize_name(translated)
+    for name, translated in COI_TRANSLATIONS.items()}
 
-    # from the name itself
-    to_search.add(name)
-    to_search.update(x.strip() for x in name.split('/'))
 
-    # explode the underscore/space combinations
-    for item in list(to_search):
-        to_search.add(item.replace('_', ' '))
-        to_search.add(item.replace(' ', '_'))
+def rank_coi_candidates(coi_index, names, limit=3):
+    """Return the most similar names in the index (best first) with their similarity."""
+    ranked = []
+    for name in names:
+        # only compare in detail with those that share enough trigrams
+        matcher = SequenceMatcher(b=name)
+        for _, indexed_name, _, _ in coi_index.search_index.find(name, limit=limit * 3):
+            matcher.set_seq1(indexed_name)
+            ranked.append((matcher.ratio(), indexed_name))
+    ranked.sort(reverse=True)
+    return ranked[:limit]
+
+
+def get_coi(coi_index, url, name):
+    """Try to find the COI from the url or name."""
+    # from the url, and the name itself (which may have several parts)
+    to_search = [url.split('/')[-1], name]
+    to_search.extend(x.strip() for x in name.split('/'))
+    to_search = [normalize_name(x) for x in to_search]
 
     # maybe translate
     for name in list(to_search):
-        if name in COI_TRANSLATIONS:
-            translated = COI_TRANSLATIONS[name]
+        if name in _NORMALIZED_COI_TRANSLATIONS:
+            translated = _NORMALIZED_COI_TRANSLATIONS[name]
             if translated is None:
                 # special flag, ignore this! exit here so no warning is shown later
                 return
-            to_search.add(translated)
+            to_search.append(translated)
 
     # search
     for name in to_search:
-        if name in coi_db:
-            return coi_db[name]
+        if name in coi_index:
+            return coi_index[name]
 
-    # nothing!
+    # nothing! show the most similar ones, to add the right one to COI_TRANSLATIONS
     print("    WARNING! COI not found:", to_search)
+    for ratio, found in rank_coi_candidates(coi_index, set(to_search)):
+        print("        candidate {!r} -> {!r} ({:.2f})".format(found, coi_index[found], ratio))
     return
 
 
-def complete(main_db, coi_db):
-    """Complete the DB."""
-    for item in main_db:
-        if item.get(PROCESSED_FLAG):
-            continue
+def _get_title(item):
+    """Get the page title for the item, from its url."""
+    return parse.unquote(item['url'].split('/')[-1])
+
+
+def _get_revision_id(data):
+    """Get the id of the revision from the page's data."""
+    (page,) = data['query']['pages'].values()
+    (revinfo,) = page['revisions']
+    return revinfo['revid']
+
+
+def _no_save(item):
+    """Default for not saving the item anywhere while processing."""
+
+
+def complete_batch(items, coi_index, max_age=None, save=_no_save):
+    """Complete a batch of items of the DB, querying the server for all of them at once.
+
+    Each item is given to `save` as soon as it's finished; if the server can't give what's
+    needed, the items of the batch are left not processed (for the next run).
+    """
+    try:
+        country_pages = get_pages(
+            COUNTRY_INFO_URL, [_get_title(item) for item in items], max_age=max_age)
+    except Exception as err:
+        print("ERROR: skipping because crashed while getting the pages for",
+              [item['name'] for item in items], err)
+        return
 
+    infos = []
+    for item in items:
         print("Processing", repr(item['name']), item['url'])
+        data = country_pages[_get_title(item)]
+        if data is None:
+            print("ERROR: skipping because page not found for", item)
+            continue
+        item[REVISION_ID] = _get_revision_id(data)
         try:
-            country_info = process(item['url'])
+            with metrics.measure('parse', country=item['name']):
+                country_info = parse_country_info(item['url'].split('/')[-1], data)
         except SkipError:
             item[PROCESSED_FLAG] = PROCESSED_IGNORE
+            save(item)
             print("Skipping!", item)
             continue
         except Exception as err:
             print("ERROR: skipping because crashed while processing stuff from", item, err)
             continue
+        infos.append((item, country_info))
 
-        # process images
-        for field_name, image_name in country_info.pop(IMAGES_CONTAINER).items():
-            country_info[field_name] = get_image_url(image_name)
+    # resolve all the images of the batch together
+    filenames = {
+        image_name
+        for _, country_info in infos
+        for image_name in country_info[IMAGES_CONTAINER].values()}
+    try:
+        image_pages = get_pages(
+            IMAGE_QUERY_URL, sorted('File:' + fname for fname in filenames), max_age=max_age)
+    except Exception as err:
+        print("ERROR: skipping because crashed while getting the images for",
+              [item['name'] for item, _ in infos], err)
+        return
+
+    for item, country_info in infos:
+        try:
+            for field_name, image_name in country_info.pop(IMAGES_CONTAINER).items():
+                country_info[field_name] = parse_image_url(image_pages['File:' + image_name])
+        except Exception as err:
+            print("ERROR: skipping because crashed while getting image urls for", item, err)
+            continue
 
         # process code
         iso_code = country_info.pop('iso_code')
-        coi_code = get_coi(coi_db, item['url'], item['name'])
+        coi_code = get_coi(coi_index, item['url'], item['name'])
         if coi_code is None or iso_code == coi_code:
             code = iso_code
         else:
@@ -322,52 +582,111 @@ def complete(main_db, coi_db):
 
         item.update(country_info)
         item[PROCESSED_FLAG] = PROCESSED_OK
+        save(item)
 
 
-def _backup(filepath):
-    """Create a backup of the given file."""
-    if not os.path.exists(filepath):
-        return
-    directory, filename = os.path.split(filepath)
-    backup_filepath = os.path.join(directory, ".{}.bkp".format(filename))
-    print("Doing backup from {!r} to {!r}".format(filepath, backup_filepath))
-    if os.path.exists(backup_filepath):
-        os.unlink(backup_filepath)
-    shutil.copy(filepath, backup_filepath)
-    return backup_filepath
+def mark_outdated(main_db, save=_no_save):
+    """Unmark as processed the items whose page changed since they were processed.
+
+    Returns how many items were unmarked.
+    """
+    processed = [item for item in main_db if item.get(PROCESSED_FLAG)]
+    last_revisions = get_pages(
+        LAST_REVISION_URL, [_get_title(item) for item in processed], max_age=0)
 
+    outdated = 0
+    for item in processed:
+        data = last_revisions[_get_title(item)]
+        if data is None:
+            continue
+        (page,) = data['query']['pages'].values()
+        if item.get(REVISION_ID) != page['lastrevid']:
+            print("Outdated", repr(item['name']), item.get(REVISION_ID), page['lastrevid'])
+            del item[PROCESSED_FLAG]
+            save(item)
+            outdated += 1
+    return outdated
+
+
+def complete(main_db, coi_index, workers=1, max_age=None, save=_no_save):
+    """Complete the DB, processing several batches concurrently if more than one worker."""
+    pending = [item for item in main_db if not item.get(PROCESSED_FLAG)]
+
+    # split in batches, but small enough so all workers have something to do
+    batch_size = max(1, min(BATCH_SIZE, -(-len(pending) // workers)))
+    batches = [pending[pos:pos + batch_size] for pos in range(0, len(pending), batch_size)]
+    if workers == 1:
+        for batch in batches:
+            complete_batch(batch, coi_index, max_age=max_age, save=save)
+        return
 
-def main(main_filepath, coi_filepath):
-    """Wrapper to be resilient about file handling."""
-    db_backup = _backup(main_filepath)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(complete_batch, batch, coi_index, max_age=max_age, save=save)
+            for batch in batches]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            # don't start anything new, the DB will be saved with what was done so far
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def main(main_filepath, coi_filepath, store_filepath, workers=1, refresh=False):
+    """Wrapper to be resilient about file handling.
+
+    Each item is saved in the store as soon as it's processed, so nothing is lost if
+    interrupted; at the end everything is exported to the JSON file.
+    """
+    store = CountryStore(store_filepath)
+    if store.is_empty():
+        print("Importing {!r} in the store".format(main_filepath))
+        store.import_json(main_filepath)
 
     # load stuff
-    with open(main_filepath, "rt", encoding="ascii") as fh:
-        main_db = json.load(fh)
+    main_db = store.load()
     with open(coi_filepath, "rt", encoding="ascii") as fh:
-        coi_db = json.load(fh)  # no backup on this, read only!
+        coi_index = build_coi_index(json.load(fh))  # read only!
     print("DBs loaded ok")
 
     try:
-        complete(main_db, coi_db)
+        if refresh:
+            # only refetch what changed, but really from the server, not the cache
+            outdated = mark_outdated(main_db, save=store.save)
+            print("Items to refresh:", outdated)
+            complete(main_db, coi_index, workers=workers, max_age=0, save=store.save)
+        else:
+            complete(main_db, coi_index, workers=workers, save=store.save)
     finally:
-        print("Writing DB")
-        with open(main_filepath, "wt", encoding="ascii") as fh:
-            json.dump(main_db, fh)
-
-        # all went fine, remove old backup
-        if db_backup:
-            os.unlink(db_backup)
+        print("Exporting DB")
+        store.export_json(main_filepath)
+        store.close()
+        metrics.save_report('fill_country_info')
         print("Done")
 
 
 if __name__ == "__main__":
     main_db_filepath = 'countries_data.json'
     coi_db_filepath = 'coi_data.json'
+    store_filepath = 'countries_data.sqlite'
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--workers', type=int, default=1, help="How many countries to process concurrently.")
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help="Reprocess the countries whose Wikipedia page changed since last run.")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
 
     for fpath in (main_db_filepath, coi_db_filepath):
         if not os.path.exists(fpath):
             print("ERROR: Missing needed file {!r} -- Please check README.".format(fpath))
             exit()
 
-    main(main_db_filepath, coi_db_filepath)
+    main(
+        main_db_filepath, coi_db_filepath, store_filepath,
+        workers=args.workers, refresh=args.refresh)
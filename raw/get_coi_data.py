@@ -1,10 +1,15 @@
 #!/usr/bin/env fades
 
 import json
+import os
 
-import requests  # fades
 from bs4 import BeautifulSoup  # fades
-from clize import run  # fades
+# used by webcache, declared here as fades only reads the script it runs
+import requests  # NOQA  # fades
+
+import metrics
+import webcache
+from searchindex import SearchIndex
 
 BASE_URL = "https://es.wikipedia.org"
 DATA_SRC = "/wiki/Anexo:Códigos_del_COI"
@@ -17,12 +22,33 @@ HEADERS = [
 ]
 
 FILENAME = "coi_data.json"
+INDEX_FILENAME = "coi_index.json"
+
+
+def load_index():
+    """Load the search index.
+
+    It can't be built from the COI data, as the historical codes are only in the index, so if
+    it's missing or older than the data it must be downloaded again.
+    """
+    if not os.path.exists(INDEX_FILENAME) or (
+            os.path.exists(FILENAME) and
+            os.path.getmtime(INDEX_FILENAME) < os.path.getmtime(FILENAME)):
+        raise ValueError(
+            "The search index {!r} is missing or outdated, run 'download' again".format(
+                INDEX_FILENAME))
+    return SearchIndex.load(INDEX_FILENAME)
+
+
+def find(text, limit=10):
+    """Find the federations most similar to the text, in the stored search index."""
+    return load_index().find(text, limit=limit)
 
 
 def download():
     """Download and process the info from Wikipedia."""
     # get the page
-    resp = requests.get(BASE_URL + DATA_SRC)
+    resp = webcache.get(BASE_URL + DATA_SRC)
     soup = BeautifulSoup(resp.text, features="html.parser")
 
     # find the useful table
@@ -36,6 +62,7 @@ def download():
 
     # get the rest of the table
     table_data = {}
+    index_entries = []
     for row in rows:
         if row.find('h5'):
             # initial letter section row
@@ -43,9 +70,6 @@ def download():
 
         columns = row.find_all('td')
         until = columns[col_positions['until']].text.strip()
-        if until:
-            # deprecated code
-            continue
 
         urlitem = columns[col_positions['urlitem']]
         names = {x.strip() for x in urlitem.strings if x != '\xa0'}
@@ -53,23 +77,37 @@ def download():
         assert names
 
         code = columns[col_positions['code']].text.strip()
+        index_entries.extend((name, code, until) for name in sorted(names))
+        if until:
+            # deprecated code, only for searching
+            continue
+
         for name in names:
             assert name not in table_data, repr(name)
             table_data[name] = code
 
     with open(FILENAME, "wt", encoding="utf8") as fh:
         json.dump(table_data, fh)
+    SearchIndex(index_entries).save(INDEX_FILENAME)
+    metrics.save_report('get_coi_data')
+
 
+def search(text, *, limit=10):
+    """Search a given text in the COI dumped data.
 
-def search(text):
-    """Search a given text in the COI dumped data."""
-    with open(FILENAME, "rt", encoding="utf8") as fh:
-        data = json.load(fh)
-    text = text.lower()
-    for k, v in data.items():
-        if text in k.lower():
-            print("{!r} -> {!r}".format(k, v))
+    :param limit: how many results to show, best first.
+    """
+    try:
+        found = find(text, limit=limit)
+    except ValueError as err:
+        print("ERROR:", err)
+        return
+    for score, name, code, until in found:
+        historic = " (until {})".format(until) if until else ""
+        print("{!r} -> {!r}{}  [{:.2f}]".format(name, code, historic, score))
 
 
 if __name__ == '__main__':
+    from clize import run  # fades
+
     run(download, search)
@@ -2,8 +2,13 @@
 
 import json
 
-import requests  # fades
 from bs4 import BeautifulSoup  # fades
+# used by webcache, declared here as fades only reads the script it runs
+import requests  # NOQA  # fades
+
+import metrics
+import webcache
+from countries_store import CountryStore
 
 BASE_URL = "https://es.wikipedia.org"
 DATA_SRC = "/wiki/Anexo:Países"
@@ -16,7 +21,7 @@ HEADERS = [
 ]
 
 # get the page
-resp = requests.get(BASE_URL + DATA_SRC)
+resp = webcache.get(BASE_URL + DATA_SRC)
 soup = BeautifulSoup(resp.text, features="html.parser")
 
 # find the useful table
@@ -51,3 +56,10 @@ for row in rows:
 
 with open("countries_data.json", "wt", encoding="utf8") as fh:
     json.dump(table_data, fh)
+
+# also keep the store updated (not losing what was already processed for each country)
+store = CountryStore()
+store.merge(table_data)
+store.close()
+
+metrics.save_report('get_countries_data')
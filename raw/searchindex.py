@@ -0,0 +1,80 @@
+"""A trigram index over names, to find them in a fuzzy way.
+
+Used by get_coi_data.py to search the federations, and by fill_country_info.py to match the
+countries with their COI codes.
+"""
+
+import json
+import unicodedata
+from collections import Counter
+
+
+def normalize_text(text):
+    """Normalize the text for searching: no case, accents or punctuation, single spaces."""
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(
+        char if char.isalnum() else ' ' for char in text if not unicodedata.combining(char))
+    return ' '.join(text.split())
+
+
+def trigrams(text):
+    """Get the trigrams of the (already normalized) text, marking the words' beginnings."""
+    padded = '  ' + text + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """A trigram index over the names of federations, to find them in a fuzzy way.
+
+    Each entry is a (name, code, until) tuple, where `until` is empty for current codes.
+    """
+
+    def __init__(self, entries):
+        self.entries = [tuple(entry) for entry in entries]
+        self.normalized = [normalize_text(name) for name, _, _ in self.entries]
+        self.sizes = []
+        self.postings = {}
+        for idx, name in enumerate(self.normalized):
+            name_trigrams = trigrams(name)
+            self.sizes.append(len(name_trigrams))
+            for trigram in name_trigrams:
+                self.postings.setdefault(trigram, []).append(idx)
+
+    def save(self, filepath):
+        """Save the index to disk."""
+        with open(filepath, "wt", encoding="utf8") as fh:
+            json.dump(vars(self), fh)
+
+    @classmethod
+    def load(cls, filepath):
+        """Load the index from disk, without processing anything again."""
+        with open(filepath, "rt", encoding="utf8") as fh:
+            data = json.load(fh)
+        index = cls.__new__(cls)
+        vars(index).update(data)
+        index.entries = [tuple(entry) for entry in index.entries]
+        return index
+
+    def find(self, text, limit=10):
+        """Find the entries most similar to the text, as (score, name, code, until), best first.
+
+        The score is the proportion of shared trigrams, plus a bonus if the text is the
+        beginning of a word of the name, or is just included in it.
+        """
+        text = normalize_text(text)
+        text_trigrams = trigrams(text)
+        common = Counter()
+        for trigram in text_trigrams:
+            common.update(self.postings.get(trigram, ()))
+
+        results = []
+        for idx, shared in common.items():
+            score = shared / (len(text_trigrams) + self.sizes[idx] - shared)
+            name = self.normalized[idx]
+            if name.startswith(text) or ' ' + text in name:
+                score += 0.5
+            elif text in name:
+                score += 0.25
+            results.append((score, *self.entries[idx]))
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return results[:limit]
@@ -0,0 +1,242 @@
+"""Benchmarks for the wikitext parsing hot path.
+
+Run it from the project's root directory:
+
+    python raw/tests/benchmark.py           # measure, and compare against the saved baseline
+    python raw/tests/benchmark.py --save    # measure, and save the results as the new baseline
+
+Each case is measured over all the fixtures, and over synthetic infoboxes built from them
+that are 10x and 100x bigger (more fields) and deeper (more nested templates). Throughput
+and peak memory are reported; when compared against the baseline, the run fails if any case
+got slower or uses more memory than the given tolerance.
+
+To absorb the speed variations of the machine itself, a fixed reference workload is also
+measured in every run, and the throughputs are compared relative to it. Anyway, the baseline is
+specific to the machine where it was saved, so it's not versioned.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BASEDIR))
+
+import fill_country_info  # NOQA (import after fixing the path)
+
+BASELINE_FILEPATH = os.path.join(BASEDIR, "benchmark_baseline.json")
+
+# each case is measured several times (keeping the best one, as `timeit` recommends), each
+# one during at least this time in seconds
+REPEATS = 3
+MIN_MEASURE_TIME = 0.2
+
+SCALES = [1, 10, 100]
+
+REFERENCE = "(reference workload)"
+
+# fields that look like those in the real infoboxes, to build bigger ones
+SYNTHETIC_FIELD = (
+    "| campo_{idx} = {{{{nowrap|[[Enlace {idx}|texto {idx}]]}}}}"
+    "<ref name=r{idx}>{{{{cita web|url=http://example.com/{idx}|título=T}}}}</ref>"
+    "<!-- comentario {idx} -->\n"
+)
+SYNTHETIC_NESTED = "{{lang|es|"
+
+
+def _load_fixtures():
+    """Load all the country info fixtures."""
+    fixtures = {}
+    for filepath in sorted(glob.glob(os.path.join(BASEDIR, "fixtures", "country_info_*.json"))):
+        with open(filepath, "rt", encoding="utf8") as fh:
+            data = json.load(fh)
+        country = os.path.basename(filepath)[len("country_info_"):-len(".json")]
+        fixtures[country] = data
+    return fixtures
+
+
+def _get_rawinfo(data):
+    """Get the wikitext from the response."""
+    (page,) = data['query']['pages'].values()
+    (revinfo,) = page['revisions']
+    return revinfo['slots']['main']['*']
+
+
+def _build_response(rawinfo):
+    """Build a response as the one from the server for the given wikitext."""
+    slot = {'contentformat': 'text/x-wiki', '*': rawinfo}
+    return {'query': {'pages': {'1': {'revisions': [{'slots': {'main': slot}}]}}}}
+
+
+def _scale(rawinfo, scale):
+    """Build a synthetic infobox with `scale` times the fields, and nesting depth."""
+    if scale == 1:
+        return rawinfo
+    fields_quant = rawinfo.count('\n|') * (scale - 1)
+    extra_fields = "".join(SYNTHETIC_FIELD.format(idx=idx) for idx in range(fields_quant))
+    nested = "| anidado = " + SYNTHETIC_NESTED * scale * 10 + "valor" + "}}" * scale * 10 + "\n"
+    pos = rawinfo.index('\n|')
+    return rawinfo[:pos + 1] + extra_fields + nested + rawinfo[pos + 1:]
+
+
+def build_cases():
+    """Build all the cases to measure: (name, function, quantity of processed bytes)."""
+    fixtures = _load_fixtures()
+    coi_index = fill_country_info.build_coi_index(
+        {"Afganistán": "AFG", "Alemania": "GER", "Gran Bretaña": "GBR", "Cuba": "CUB"})
+
+    cases = [(REFERENCE, _reference_workload, 0)]
+    for scale in SCALES:
+        responses = [
+            (country, _build_response(_scale(_get_rawinfo(data), scale)))
+            for country, data in fixtures.items()]
+        size = sum(len(_get_rawinfo(data)) for _, data in responses)
+
+        def parse_all(responses=responses):
+            for country, data in responses:
+                try:
+                    fill_country_info.parse_country_info(country, data)
+                except Exception:
+                    pass  # some fixtures are not countries, or have data fixed by OVERRULE
+
+        def country_info_all(responses=responses):
+            for country, data in responses:
+                fill_country_info.CountryInfo(country, data)
+
+        cases.append(("parse_country_info x{}".format(scale), parse_all, size))
+        cases.append(("CountryInfo x{}".format(scale), country_info_all, size))
+
+        texts = [
+            "''República Federal de Alemania''<br />, -na{{refn|nota}}",
+            "alemán, -na" * scale,
+        ]
+        payloads = ["lang|de|Bundesrepublik Deutschland" * scale, "Kabul" * scale]
+        texts_size = sum(len(t) for t in texts)
+        payloads_size = sum(len(p) for p in payloads)
+
+        def simplify_all(texts=texts):
+            for text in texts:
+                fill_country_info.simplify(text)
+
+        def extract_payload_all(payloads=payloads):
+            for payload in payloads:
+                fill_country_info.extract_payload(payload)
+
+        cases.append(("simplify x{}".format(scale), simplify_all, texts_size))
+        cases.append(("extract_payload x{}".format(scale), extract_payload_all, payloads_size))
+
+    countries = [
+        ("https://es.wikipedia.org/wiki/" + name.replace(' ', '_'), name)
+        for name in ["Afganistán", "Reino Unido", "República Democrática del Congo", "Cuba"]]
+    names_size = sum(len(url) + len(name) for url, name in countries)
+
+    def get_coi_all():
+        for url, name in countries:
+            fill_country_info.get_coi(coi_index, url, name)
+
+    cases.append(("get_coi", get_coi_all, names_size))
+    return cases
+
+
+def measure(function, size):
+    """Measure throughput (calls and MB per second) and peak memory of the function."""
+    best_rate = 0
+    for _ in range(REPEATS):
+        loops = 0
+        start = time.perf_counter()
+        while True:
+            function()
+            loops += 1
+            elapsed = time.perf_counter() - start
+            if elapsed > MIN_MEASURE_TIME:
+                break
+        best_rate = max(best_rate, loops / elapsed)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'calls_per_sec': best_rate,
+        'mb_per_sec': best_rate * size / 2 ** 20,
+        'peak_memory_kb': peak / 1024,
+    }
+
+
+def _reference_workload():
+    """Something fixed, pure Python and string heavy, to calibrate the machine speed."""
+    text = "{{lang|es|[[Enlace|texto]]}} " * 200
+    for _ in range(20):
+        parts = text.split('|')
+        text = '|'.join(part.strip() + ' ' for part in parts)[:len(text)]
+
+
+def compare(results, baseline, tolerance):
+    """Compare the results against the baseline, returning the found regressions."""
+    regressions = []
+    speed = results[REFERENCE]['calls_per_sec'] / baseline[REFERENCE]['calls_per_sec']
+    for name, result in results.items():
+        if name not in baseline or name == REFERENCE:
+            continue
+        base = baseline[name]
+        expected = base['calls_per_sec'] * speed
+        if result['calls_per_sec'] < expected * (1 - tolerance):
+            regressions.append(
+                "{}: throughput {:.1f}/s, baseline {:.1f}/s (adjusted for machine speed)".format(
+                    name, result['calls_per_sec'], expected))
+        if result['peak_memory_kb'] > base['peak_memory_kb'] * (1 + tolerance):
+            regressions.append("{}: peak memory {:.1f} KB, baseline {:.1f} KB".format(
+                name, result['peak_memory_kb'], base['peak_memory_kb']))
+    return regressions
+
+
+def main(save, tolerance):
+    """Main entry point."""
+    # the code under test prints warnings, we don't want them mixed with the report
+    real_stdout = sys.stdout
+    results = {}
+    print("{:30s} {:>12s} {:>10s} {:>12s}".format("case", "calls/s", "MB/s", "peak KB"))
+    for name, function, size in build_cases():
+        sys.stdout = open(os.devnull, "wt")
+        try:
+            result = measure(function, size)
+        finally:
+            sys.stdout.close()
+            sys.stdout = real_stdout
+        results[name] = result
+        print("{:30s} {:12.1f} {:10.2f} {:12.1f}".format(
+            name, result['calls_per_sec'], result['mb_per_sec'], result['peak_memory_kb']))
+
+    if save:
+        with open(BASELINE_FILEPATH, "wt", encoding="utf8") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+        print("Baseline saved in", BASELINE_FILEPATH)
+        return
+
+    if not os.path.exists(BASELINE_FILEPATH):
+        print("No baseline to compare, save one with --save")
+        return
+    with open(BASELINE_FILEPATH, "rt", encoding="utf8") as fh:
+        baseline = json.load(fh)
+    regressions = compare(results, baseline, tolerance)
+    if regressions:
+        print("REGRESSIONS found (tolerance {:.0%}):".format(tolerance))
+        for line in regressions:
+            print("   ", line)
+        exit(1)
+    print("No regressions (tolerance {:.0%})".format(tolerance))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save', action='store_true', help="Save the results as new baseline.")
+    parser.add_argument(
+        '--tolerance', type=float, default=0.3,
+        help="Allowed relative degradation before failing (default: %(default)s).")
+    args = parser.parse_args()
+    main(args.save, args.tolerance)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts are run from the 'raw' directory and import their helper modules directly
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -1,6 +1,12 @@
 import json
 import os
+import time
+from urllib import parse
 
+import pytest
+
+from raw import (
+    countries_store, download_images, fill_country_info, get_coi_data, searchindex, webcache)
 from raw.fill_country_info import parse_image_url, parse_country_info, IMAGES_CONTAINER
 
 BASEDIR = os.path.dirname(__file__)
@@ -359,3 +365,594 @@ def test_country_info_singapur():
         'world_location_url': 'Singapore in its region (zoom).svg',
     }
     assert result == should
+
+
+def test_get_pages_batched_normalized_redirected(monkeypatch):
+    response = {
+        'query': {
+            'normalized': [{'from': 'Costa_de_Marfil', 'to': 'Costa de Marfil'}],
+            'redirects': [{'from': 'Costa de Marfil', 'to': 'Costa de Marfil (país)'}],
+            'pages': {
+                '11': {'pageid': 11, 'title': 'Costa de Marfil (país)', 'revisions': ['civ']},
+                '22': {'pageid': 22, 'title': 'Cuba', 'revisions': ['cub']},
+                '-1': {'title': 'Narnia', 'missing': ''},
+            },
+        },
+    }
+    queried = []
+
+    def fake_get_json(url, max_age=None):
+        queried.append(url)
+        return response
+
+    monkeypatch.setattr(fill_country_info, 'get_json', fake_get_json)
+    result = fill_country_info.get_pages(
+        fill_country_info.COUNTRY_INFO_URL, ['Costa_de_Marfil', 'Cuba', 'Narnia'])
+    assert len(queried) == 1
+    assert 'Costa_de_Marfil%7CCuba%7CNarnia' in queried[0]
+    assert result == {
+        'Costa_de_Marfil': {'query': {'pages': {'11': response['query']['pages']['11']}}},
+        'Cuba': {'query': {'pages': {'22': response['query']['pages']['22']}}},
+        'Narnia': None,
+    }
+
+
+def test_get_pages_continued(monkeypatch):
+    responses = [
+        {
+            'continue': {'iicontinue': 'b', 'continue': '||'},
+            'query': {'pages': {
+                '1': {'pageid': 1, 'title': 'File:A.svg', 'imageinfo': [{'url': 'url-a'}]},
+                '2': {'pageid': 2, 'title': 'File:B.svg'},
+            }},
+        },
+        {
+            'query': {'pages': {
+                '2': {'pageid': 2, 'title': 'File:B.svg', 'imageinfo': [{'url': 'url-b'}]},
+            }},
+        },
+    ]
+    monkeypatch.setattr(fill_country_info, 'get_json', lambda url, max_age=None: responses.pop(0))
+    result = fill_country_info.get_pages(
+        fill_country_info.IMAGE_QUERY_URL, ['File:A.svg', 'File:B.svg'])
+    assert parse_image_url(result['File:A.svg']) == 'url-a'
+    assert parse_image_url(result['File:B.svg']) == 'url-b'
+
+
+def _fake_wikipedia(monkeypatch, failing=()):
+    """Answer the queries for the countries and their images, crashing for some titles."""
+
+    def fake_get_json(url, max_age=None):
+        titles = parse.unquote(url.split('&titles=')[1]).split('|')
+        if set(titles) & set(failing):
+            raise ValueError("Server still lagged")
+        pages = {}
+        for pageid, title in enumerate(titles, 1):
+            if title.startswith('File:'):
+                pages[str(pageid)] = {
+                    'pageid': pageid, 'title': title, 'imageinfo': [{'url': 'url-' + title}]}
+            else:
+                pages[str(pageid)] = {
+                    'pageid': pageid, 'title': title, 'revisions': [{'revid': len(title)}]}
+        return {'query': {'pages': pages}}
+
+    def fake_parse_country_info(country, data):
+        return {'iso_code': country[:3].upper(), IMAGES_CONTAINER: {'flag_url': country + '.svg'}}
+
+    monkeypatch.setattr(fill_country_info, 'get_json', fake_get_json)
+    monkeypatch.setattr(fill_country_info, 'parse_country_info', fake_parse_country_info)
+
+
+def _countries(*names):
+    return [{'name': name, 'url': 'https://es.wikipedia.org/wiki/' + name} for name in names]
+
+
+def test_complete_skips_failed_batch(monkeypatch, capsys):
+    _fake_wikipedia(monkeypatch, failing=['Narnia'])
+    main_db = _countries('Cuba', 'Chile', 'Narnia', 'Peru')
+    saved = []
+    coi_index = fill_country_info.build_coi_index(COI_DB)
+    fill_country_info.complete(main_db, coi_index, workers=2, save=saved.append)
+
+    # the batch with Narnia (and Peru) failed, the rest went on
+    assert [item['name'] for item in saved] == ['Cuba', 'Chile']
+    assert [item.get('__processed__') for item in main_db] == ['ok', 'ok', None, None]
+    assert saved[0]['flag_url'] == 'url-File:Cuba.svg'
+    assert "crashed while getting the pages for ['Narnia', 'Peru']" in capsys.readouterr().out
+
+
+def test_complete_concurrently_as_serially(monkeypatch):
+    _fake_wikipedia(monkeypatch)
+    coi_index = fill_country_info.build_coi_index(COI_DB)
+    names = ['Cuba', 'Chile', 'Peru', 'Afganistán', 'Santa_Lucía']
+    results = []
+    for workers in (1, 3):
+        main_db = _countries(*names)
+        main_db[2]['__processed__'] = 'ok'  # already done, left as is
+        saved = []
+        fill_country_info.complete(main_db, coi_index, workers=workers, save=saved.append)
+        assert len(saved) == 4
+        results.append(main_db)
+    assert results[0] == results[1]
+    assert [item['__processed__'] for item in results[1]] == ['ok'] * 5
+    assert results[1][3]['code'] == 'AFG'
+
+
+class _FakeWebcache:
+    def __init__(self, responses):
+        self.responses = responses
+        self.forgotten = []
+
+    def get(self, url, fetch=None, max_age=None):
+        return self.responses.pop(0)
+
+    def forget(self, url):
+        self.forgotten.append(url)
+
+
+def _api_response(status_code, data=None, headers=None, from_cache=False):
+    return webcache.CachedResponse(
+        'http://example.com/api', status_code, json.dumps(data or {}).encode('utf8'),
+        headers or {}, 'utf8', from_cache=from_cache)
+
+
+def test_get_json_backs_off(monkeypatch):
+    fake_cache = _FakeWebcache([
+        _api_response(429, headers={'Retry-After': '3'}),
+        _api_response(200, {'error': {'code': 'maxlag'}}, {'Retry-After': '2'}),
+        _api_response(200, {'query': 'stuff'}),
+    ])
+    rate_limiter = fill_country_info.RateLimiter()
+    monkeypatch.setattr(fill_country_info, 'webcache', fake_cache)
+    monkeypatch.setattr(fill_country_info, 'rate_limiter', rate_limiter)
+
+    tini = time.monotonic()
+    assert fill_country_info.get_json('http://example.com/api') == {'query': 'stuff'}
+    assert fake_cache.forgotten == ['http://example.com/api'] * 2
+    # twice slowed down, then relaxed once
+    assert rate_limiter.delay == pytest.approx(0.2 * 0.9)
+    assert rate_limiter._next_request >= tini + 3
+
+
+def test_get_json_still_lagged(monkeypatch):
+    retries = fill_country_info.MAX_RETRIES
+    fake_cache = _FakeWebcache([_api_response(503) for _ in range(retries)])
+    monkeypatch.setattr(fill_country_info, 'webcache', fake_cache)
+    monkeypatch.setattr(fill_country_info, 'rate_limiter', fill_country_info.RateLimiter())
+    with pytest.raises(ValueError):
+        fill_country_info.get_json('http://example.com/api')
+    assert len(fake_cache.forgotten) == retries
+
+
+def test_get_json_from_cache_does_not_relax(monkeypatch):
+    fake_cache = _FakeWebcache([_api_response(200, {'query': 'x'}, from_cache=True)])
+    rate_limiter = fill_country_info.RateLimiter()
+    rate_limiter.delay = 1
+    monkeypatch.setattr(fill_country_info, 'webcache', fake_cache)
+    monkeypatch.setattr(fill_country_info, 'rate_limiter', rate_limiter)
+    fill_country_info.get_json('http://example.com/api')
+    assert rate_limiter.delay == 1
+
+
+def test_retry_after():
+    get_retry_after = fill_country_info._get_retry_after
+    assert get_retry_after(_api_response(429, headers={'Retry-After': '2.5'})) == 2.5
+    assert get_retry_after(_api_response(429)) == 1
+    # it may be a date, just guess
+    headers = {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+    assert get_retry_after(_api_response(429, headers=headers)) == 1
+
+
+def test_rate_limiter_backoff_and_relax():
+    rate_limiter = fill_country_info.RateLimiter(max_delay=0.3)
+    rate_limiter.backoff(0)
+    assert rate_limiter.delay == 0.1
+    rate_limiter.backoff(0)
+    rate_limiter.backoff(0)
+    assert rate_limiter.delay == 0.3  # limited
+    for _ in range(100):
+        rate_limiter.relax()
+    assert rate_limiter.delay == 0
+
+
+class _FakeResponse:
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.encoding = 'utf8'
+
+
+def test_webcache_revalidates_with_etag(tmp_path):
+    cache = webcache.Cache(directory=str(tmp_path), ttl=0)
+    sent_headers = []
+    responses = [
+        _FakeResponse(200, b'payload', {'ETag': '"v1"'}),
+        _FakeResponse(304),
+    ]
+
+    def fetch(url, headers):
+        sent_headers.append(headers)
+        return responses.pop(0)
+
+    first = cache.get('http://example.com/x', fetch=fetch)
+    second = cache.get('http://example.com/x', fetch=fetch)
+    assert not first.from_cache
+    assert second.from_cache
+    assert second.content == b'payload'
+    assert sent_headers == [{}, {'If-None-Match': '"v1"'}]
+
+
+def test_webcache_fresh_entries_do_not_hit_network(tmp_path):
+    cache = webcache.Cache(directory=str(tmp_path), ttl=3600)
+    cache.put('http://example.com/x', b'stored')
+
+    def fetch(url, headers):
+        raise AssertionError("should not hit the network")
+
+    assert cache.get('http://example.com/x', fetch=fetch).text == 'stored'
+
+
+def test_webcache_evicts_least_recently_used(tmp_path):
+    cache = webcache.Cache(directory=str(tmp_path), max_size=10)
+    cache.put('http://example.com/a', b'aaaa')
+    cache.put('http://example.com/b', b'bbbb')
+    os.utime(cache._paths('http://example.com/a')[0], (1, 1))  # 'a' is the oldest used
+    cache.put('http://example.com/c', b'cccc')
+    assert cache.lookup('http://example.com/a') is None
+    assert cache.lookup('http://example.com/b').content == b'bbbb'
+    assert cache.lookup('http://example.com/c').content == b'cccc'
+
+
+def test_webcache_put_interrupted(tmp_path, monkeypatch):
+    cache = webcache.Cache(directory=str(tmp_path))
+    cache.put('http://example.com/x', b'old payload')
+
+    # interrupted after the new body is in place, but not its metadata
+    real_replace = os.replace
+
+    def fail_with_metadata(src, dst):
+        if dst.endswith('.json'):
+            raise KeyboardInterrupt()
+        real_replace(src, dst)
+
+    monkeypatch.setattr(webcache.os, 'replace', fail_with_metadata)
+    with pytest.raises(KeyboardInterrupt):
+        cache.put('http://example.com/x', b'new')
+    assert cache.lookup('http://example.com/x') is None
+
+
+def test_mark_outdated(monkeypatch):
+    main_db = [
+        {'name': 'Cuba', 'url': 'https://es.wikipedia.org/wiki/Cuba', 'revid': 10,
+         '__processed__': 'ok'},
+        {'name': 'Chile', 'url': 'https://es.wikipedia.org/wiki/Chile', 'revid': 20,
+         '__processed__': 'ok'},
+        {'name': 'Perú', 'url': 'https://es.wikipedia.org/wiki/Per%C3%BA',
+         '__processed__': 'ignore'},
+        {'name': 'Togo', 'url': 'https://es.wikipedia.org/wiki/Togo'},
+    ]
+    response = {
+        'query': {
+            'pages': {
+                '1': {'pageid': 1, 'title': 'Cuba', 'lastrevid': 10},
+                '2': {'pageid': 2, 'title': 'Chile', 'lastrevid': 25},
+                '3': {'pageid': 3, 'title': 'Perú', 'lastrevid': 30},
+            },
+        },
+    }
+    queried = []
+
+    def fake_get_json(url, max_age=None):
+        queried.append((url, max_age))
+        return response
+
+    monkeypatch.setattr(fill_country_info, 'get_json', fake_get_json)
+    outdated = fill_country_info.mark_outdated(main_db)
+    assert outdated == 2
+    assert [item.get('__processed__') for item in main_db] == ['ok', None, None, None]
+    ((url, max_age),) = queried
+    assert 'prop=info' in url
+    assert max_age == 0
+
+
+def test_reduce_markup_nested():
+    raw = (
+        "{{Ficha de país|nombre={{lang|es|[[Reino (país)|Reino]] de {{nowrap|Algo}}}}"
+        "<ref name=x>{{cita|título=T}}</ref><!-- a {{comment}} -->|capital=[[Capital]]"
+        "<ref name=y />}}")
+    reduced = fill_country_info.reduce_markup(raw)
+    assert reduced == "nombre=Reino de Algo|capital=Capital"
+    elements = fill_country_info.parse_elements(reduced)
+    assert elements == {'nombre': 'Reino de Algo', 'capital': 'Capital'}
+
+
+def test_reduce_markup_unbalanced():
+    assert fill_country_info.reduce_markup("a}} b {{c|d") == "a}} b {{c|d"
+
+
+def test_store_merge_keeps_processed_data(tmp_path):
+    store = countries_store.CountryStore(str(tmp_path / "store.sqlite"))
+    store.merge([
+        {'name': 'Cuba', 'url': 'https://es.wikipedia.org/wiki/Cuba', 'continent': 'América'},
+        {'name': 'Chile', 'url': 'https://es.wikipedia.org/wiki/Chile', 'continent': 'América'},
+    ])
+    item = store.get(name='Cuba')
+    item.update({'code': 'CUB', '__processed__': 'ok'})
+    store.save(item)
+
+    # data downloaded again, the processed info is kept
+    store.merge([
+        {'name': 'Cuba', 'url': 'https://es.wikipedia.org/wiki/Cuba', 'continent': 'Caribe'},
+    ])
+    assert store.get(code='CUB') == {
+        'name': 'Cuba', 'url': 'https://es.wikipedia.org/wiki/Cuba', 'continent': 'Caribe',
+        'code': 'CUB', '__processed__': 'ok'}
+    assert [item['name'] for item in store.load()] == ['Cuba', 'Chile']
+    assert [item['name'] for item in store.load(only_processed_ok=True)] == ['Cuba']
+    store.close()
+
+
+def test_store_exports(tmp_path):
+    store = countries_store.CountryStore(str(tmp_path / "store.sqlite"))
+    items = [
+        {'name': 'Cuba', 'url': 'https://es.wikipedia.org/wiki/Cuba', 'code': 'CUB',
+         '__processed__': 'ok'},
+        {'name': 'Chile', 'url': 'https://es.wikipedia.org/wiki/Chile'},
+    ]
+    store.merge(items)
+
+    json_path = str(tmp_path / "data.json")
+    store.export_json(json_path)
+    with open(json_path, "rt", encoding="ascii") as fh:
+        assert json.load(fh) == items
+
+    csv_path = str(tmp_path / "data.csv")
+    store.export_csv(csv_path)
+    with open(csv_path, "rt", encoding="utf8") as fh:
+        lines = fh.read().splitlines()
+    assert lines[0] == ",".join(countries_store.CSV_FIELDS)
+    assert lines[1] == "Cuba,https://es.wikipedia.org/wiki/Cuba,,,,,,,,,CUB"
+    assert len(lines) == 2
+    store.close()
+
+
+def test_store_keeps_hand_fields(tmp_path):
+    json_path = str(tmp_path / 'countries_data.json')
+    store_path = str(tmp_path / 'countries_data.sqlite')
+    items = [
+        {'name': 'Cuba', 'url': 'https://es.wikipedia.org/wiki/Cuba', '__processed__': 'ok'},
+        {'name': 'Chile', 'url': 'https://es.wikipedia.org/wiki/Chile', '__processed__': 'ok'},
+    ]
+    store = countries_store.CountryStore(store_path)
+    store.merge(items)
+    store.export_json(json_path)
+
+    # the style is set by hand in the JSON, and then the store exports it again
+    with open(json_path, "rt", encoding="ascii") as fh:
+        edited = json.load(fh)
+    edited[1]['style'] = 'lang'
+    with open(json_path, "wt", encoding="ascii") as fh:
+        json.dump(edited, fh)
+    store.export_json(json_path)
+    store.close()
+
+    with open(json_path, "rt", encoding="ascii") as fh:
+        exported = json.load(fh)
+    assert [item.get('style') for item in exported] == [None, 'lang']
+    loaded = countries_store.load_db(json_path, store_path, only_processed_ok=True)
+    assert [item.get('style') for item in loaded] == [None, 'lang']
+
+
+COI_DB = {
+    'Afganistán': 'AFG',
+    'Gran Bretaña': 'GBR',
+    'República Democrática del Congo': 'COD',
+    'Santa Lucía': 'LCA',
+}
+
+
+def test_get_coi_normalized():
+    coi_index = fill_country_info.build_coi_index(COI_DB)
+    get_coi = fill_country_info.get_coi
+    assert get_coi(coi_index, 'https://es.wikipedia.org/wiki/Afganist%C3%A1n', 'X') == 'AFG'
+    assert get_coi(coi_index, 'https://es.wikipedia.org/wiki/X', 'AFGANISTAN') == 'AFG'
+    assert get_coi(coi_index, 'https://es.wikipedia.org/wiki/Santa_Luc%C3%ADa', 'X') == 'LCA'
+    assert get_coi(coi_index, 'https://es.wikipedia.org/wiki/X', 'Y / Santa Lucía') == 'LCA'
+
+
+def test_get_coi_translated():
+    coi_index = fill_country_info.build_coi_index(COI_DB)
+    get_coi = fill_country_info.get_coi
+    assert get_coi(coi_index, 'https://es.wikipedia.org/wiki/Reino_Unido', 'Reino Unido') == 'GBR'
+    url = 'https://es.wikipedia.org/wiki/Ciudad_del_Vaticano'
+    assert get_coi(coi_index, url, 'Vaticano') is None
+
+
+def test_get_coi_similar_not_accepted(capsys):
+    coi_index = fill_country_info.build_coi_index(COI_DB)
+    get_coi = fill_country_info.get_coi
+    url = 'https://es.wikipedia.org/wiki/X'
+    assert get_coi(coi_index, url, 'República Democrática de Congo') is None
+    out = capsys.readouterr().out
+    assert "COI not found" in out
+    assert "candidate 'republicademocraticadelcongo' -> 'COD'" in out
+    assert get_coi(coi_index, url, 'Narnia') is None
+    assert "COI not found" in capsys.readouterr().out
+
+
+def test_get_coi_explicit_mapping(monkeypatch):
+    monkeypatch.setattr(fill_country_info, '_NORMALIZED_COI_TRANSLATIONS', {
+        'republicademocraticadecongo': 'republicademocraticadelcongo'})
+    coi_index = fill_country_info.build_coi_index(COI_DB)
+    url = 'https://es.wikipedia.org/wiki/X'
+    assert fill_country_info.get_coi(coi_index, url, 'República Democrática de Congo') == 'COD'
+
+
+SEARCH_ENTRIES = [
+    ('Afganistán', 'AFG', ''),
+    ('Alemania', 'GER', ''),
+    ('Alemania Occidental', 'FRG', '1990'),
+    ('Alemania Oriental', 'GDR', '1990'),
+    ('República Federal de Alemania', 'FRG', '1990'),
+    ('Argentina', 'ARG', ''),
+]
+
+
+def test_search_index_ranked_accent_insensitive():
+    index = searchindex.SearchIndex(SEARCH_ENTRIES)
+    ((score, name, code, until),) = index.find('AFGANISTAN', limit=1)
+    assert (name, code, until) == ('Afganistán', 'AFG', '')
+
+    names = [name for _, name, _, _ in index.find('alemania', limit=3)]
+    assert names == ['Alemania', 'Alemania Oriental', 'Alemania Occidental']
+    assert index.find('zzz') == []
+
+
+def test_search_index_persisted(tmp_path):
+    filepath = str(tmp_path / "index.json")
+    searchindex.SearchIndex(SEARCH_ENTRIES).save(filepath)
+    index = searchindex.SearchIndex.load(filepath)
+    (result,) = index.find('occidental', limit=1)
+    assert result[1:] == ('Alemania Occidental', 'FRG', '1990')
+
+
+class _FakeStreamedResponse:
+    def __init__(self, status_code, chunks=(), headers=None):
+        self.status_code = status_code
+        self.chunks = chunks
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+
+    def close(self):
+        self.closed = True
+
+
+class _FakeSession:
+    def __init__(self, responses):
+        self.responses = responses
+        self.sent_headers = []
+
+    def get(self, url, headers, stream):
+        self.sent_headers.append(headers)
+        return self.responses[url].pop(0)
+
+
+def _store_files(store):
+    return sorted(os.listdir(store.blobs_dir))
+
+
+def test_image_store_fetch_dedups(tmp_path, monkeypatch):
+    session = _FakeSession({
+        'http://example.com/a.svg': [_FakeStreamedResponse(200, [b'same', b' image'])],
+        'http://example.com/b.svg': [_FakeStreamedResponse(200, [b'same image'])],
+    })
+    monkeypatch.setattr(download_images, 'session', session)
+    store = download_images.ImageStore(str(tmp_path))
+    progress = download_images.Progress(2)
+
+    details = {}
+    path_a = store.fetch('http://example.com/a.svg', progress, details)
+    path_b = store.fetch('http://example.com/b.svg', progress)
+    assert path_a == path_b
+    assert details == {'status': 200, 'cache': 'miss', 'bytes': 10}
+    with open(path_a, "rb") as fh:
+        assert fh.read() == b'same image'
+    assert _store_files(store) == [os.path.basename(path_a)]
+    assert progress.total_bytes == 20
+
+
+def test_image_store_fetch_incomplete(tmp_path, monkeypatch):
+    response = _FakeStreamedResponse(200, [b'half'], {'Content-Length': '8'})
+    session = _FakeSession({'http://example.com/a.svg': [response]})
+    monkeypatch.setattr(download_images, 'session', session)
+    store = download_images.ImageStore(str(tmp_path))
+
+    assert store.fetch('http://example.com/a.svg', download_images.Progress(1)) is None
+    assert response.closed
+    assert _store_files(store) == []  # the partial download was removed
+    assert store.manifest == {}
+
+
+def test_image_store_fetch_not_modified(tmp_path, monkeypatch):
+    url = 'http://example.com/a.svg'
+    session = _FakeSession({url: [
+        _FakeStreamedResponse(200, [b'image'], {'ETag': '"v1"'}),
+        _FakeStreamedResponse(304),
+    ]})
+    monkeypatch.setattr(download_images, 'session', session)
+    progress = download_images.Progress(2)
+
+    store = download_images.ImageStore(str(tmp_path))
+    first = store.fetch(url, progress)
+    store.save_manifest()
+
+    # a new run, that reads the manifest
+    store = download_images.ImageStore(str(tmp_path))
+    details = {}
+    assert store.fetch(url, progress, details) == first
+    assert details == {'status': 304, 'cache': 'revalidated'}
+    assert session.sent_headers == [{}, {'If-None-Match': '"v1"'}]
+
+
+def test_link_relative_and_replaced(tmp_path):
+    blobs = tmp_path / '.blobs'
+    blobs.mkdir()
+    (blobs / 'one.svg').write_bytes(b'1')
+    (blobs / 'two.svg').write_bytes(b'2')
+    destpath = str(tmp_path / 'Chile.flag.svg')
+
+    download_images.link(str(blobs / 'one.svg'), destpath)
+    assert os.readlink(destpath) == os.path.join('.blobs', 'one.svg')
+    download_images.link(str(blobs / 'two.svg'), destpath)
+    with open(destpath, "rb") as fh:
+        assert fh.read() == b'2'
+    assert sorted(os.listdir(tmp_path)) == ['.blobs', 'Chile.flag.svg']
+
+
+def test_download_images_reports_failures(tmp_path, monkeypatch, capsys):
+    main_db = [
+        {'name': 'Chile', 'url': 'https://es.wikipedia.org/wiki/Chile', '__processed__': 'ok',
+         'flag_url': 'http://example.com/cl.svg',
+         'world_location_url': 'http://example.com/cl-loc.png'},
+        # unmarked to be processed again, but that failed
+        {'name': 'Cuba', 'url': 'https://es.wikipedia.org/wiki/Cuba',
+         'flag_url': 'http://example.com/cu.svg',
+         'world_location_url': 'http://example.com/cu-loc.png'},
+    ]
+    store = countries_store.CountryStore(str(tmp_path / 'countries_data.sqlite'))
+    store.merge(main_db)
+    store.close()
+    session = _FakeSession({
+        'http://example.com/cl.svg': [_FakeStreamedResponse(200, [b'flag'])],
+        'http://example.com/cl-loc.png': [_FakeStreamedResponse(404)],
+    })
+    monkeypatch.setattr(download_images, 'session', session)
+    monkeypatch.chdir(tmp_path)
+
+    failed = download_images.main('countries_data.json')
+    assert failed == ['http://example.com/cl-loc.png']
+    assert "ERROR: 1 images couldn't be downloaded" in capsys.readouterr().out
+    assert os.path.exists(os.path.join('images', 'Chile.flag.svg'))
+    assert not os.path.exists(os.path.join('images', 'Chile.location.png'))
+
+
+def test_coi_index_not_rebuilt_without_history(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(get_coi_data.FILENAME, "wt", encoding="utf8") as fh:
+        json.dump({'Alemania': 'GER'}, fh)
+    with pytest.raises(ValueError):
+        get_coi_data.load_index()
+
+    searchindex.SearchIndex(SEARCH_ENTRIES).save(get_coi_data.INDEX_FILENAME)
+    os.utime(get_coi_data.FILENAME, (1, 1))
+    found = get_coi_data.find('Alemania Oriental', limit=1)
+    assert [(name, code, until) for _, name, code, until in found] == [
+        ('Alemania Oriental', 'GDR', '1990')]
+
+    # the data changed after the index was built
+    os.utime(get_coi_data.INDEX_FILENAME, (0, 0))
+    get_coi_data.search('Alemania')
@@ -0,0 +1,213 @@
+"""A persistent on-disk cache for HTTP responses, shared by all the scripts in this directory.
+
+Responses are stored by URL, revalidated with conditional GETs (ETag/Last-Modified) once they
+are older than the TTL, and the least recently used ones are evicted when the cache grows
+beyond its size limit.
+
+Defaults can be changed with the WEBCACHE_DIR, WEBCACHE_TTL (seconds) and WEBCACHE_MAX_SIZE
+(bytes) environment variables.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests  # fades
+
+import metrics
+
+CACHE_DIR = os.environ.get('WEBCACHE_DIR', '.webcache')
+TTL = int(os.environ.get('WEBCACHE_TTL', 30 * 24 * 3600))
+MAX_SIZE = int(os.environ.get('WEBCACHE_MAX_SIZE', 1024 * 2 ** 20))
+
+
+class CachedResponse:
+    """The minimal part of a `requests` response that the scripts use."""
+
+    def __init__(self, url, status_code, content, headers, encoding, from_cache):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.encoding = encoding or 'utf8'
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+
+
+class Cache:
+    """The cache itself, safe to be used from several threads."""
+
+    def __init__(self, directory=CACHE_DIR, ttl=TTL, max_size=MAX_SIZE):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._sizes = None  # key -> size of the stored body, loaded lazily
+
+    def _paths(self, url):
+        """Return the paths for the metadata and the body of the stored url."""
+        key = hashlib.sha256(url.encode('utf8')).hexdigest()
+        base = os.path.join(self.directory, key)
+        return base + '.json', base + '.body'
+
+    def _load_sizes(self):
+        """Scan the directory to know what is stored, only once."""
+        if self._sizes is not None:
+            return
+        self._sizes = {}
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.body'):
+                key = fname[:-5]
+                self._sizes[key] = os.path.getsize(os.path.join(self.directory, fname))
+
+    def _evict(self):
+        """Remove the least recently used entries until we're under the size limit."""
+        total = sum(self._sizes.values())
+        if total <= self.max_size:
+            return
+
+        def last_used(key):
+            try:
+                return os.path.getmtime(os.path.join(self.directory, key + '.json'))
+            except FileNotFoundError:
+                return 0
+
+        for key in sorted(self._sizes, key=last_used):
+            if total <= self.max_size:
+                break
+            total -= self._sizes.pop(key)
+            for ext in ('.json', '.body'):
+                try:
+                    os.remove(os.path.join(self.directory, key + ext))
+                except FileNotFoundError:
+                    pass
+
+    def lookup(self, url):
+        """Return the stored response for the url (no matter how old), or None."""
+        meta_path, body_path = self._paths(url)
+        with self._lock:
+            try:
+                with open(meta_path, "rt", encoding="utf8") as fh:
+                    meta = json.load(fh)
+                with open(body_path, "rb") as fh:
+                    content = fh.read()
+            except FileNotFoundError:
+                return None
+            os.utime(meta_path)  # mark it as recently used
+        response = CachedResponse(
+            url, 200, content, meta['headers'], meta['encoding'], from_cache=True)
+        response.fetched = meta['fetched']
+        return response
+
+    def put(self, url, content, headers=None, encoding=None, fetched=None):
+        """Store a response for the url (also useful to seed the cache from local files)."""
+        meta = {
+            'url': url,
+            'headers': dict(headers or {}),
+            'encoding': encoding,
+            'fetched': time.time() if fetched is None else fetched,
+        }
+        meta_path, body_path = self._paths(url)
+        with self._lock:
+            self._load_sizes()
+            with open(body_path + '.tmp', "wb") as fh:
+                fh.write(content)
+            with open(meta_path + '.tmp', "wt", encoding="utf8") as fh:
+                json.dump(meta, fh)
+            # without the metadata the entry is not there, so if interrupted while replacing
+            # the files a body is never served with the metadata of other one
+            try:
+                os.remove(meta_path)
+            except FileNotFoundError:
+                pass
+            os.replace(body_path + '.tmp', body_path)
+            os.replace(meta_path + '.tmp', meta_path)
+            self._sizes[os.path.basename(body_path)[:-5]] = len(content)
+            self._evict()
+
+    def forget(self, url):
+        """Remove the url from the cache, if there."""
+        meta_path, body_path = self._paths(url)
+        with self._lock:
+            for path in (meta_path, body_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            if self._sizes is not None:
+                self._sizes.pop(os.path.basename(body_path)[:-5], None)
+
+    def get(self, url, fetch=None, max_age=None):
+        """Get the url, from the cache if fresh enough, revalidating or downloading if not.
+
+        The `fetch` function (`requests.get` by default) receives the url and the headers to
+        use. Only successful responses are stored. Each call is recorded in the metrics.
+        """
+        with metrics.measure('http', url=url, bytes=0) as details:
+            response = self._get(url, fetch, max_age, details)
+            details['status'] = response.status_code
+        return response
+
+    def _get(self, url, fetch, max_age, details):
+        """Really get the url, telling in the details how it was got."""
+        if fetch is None:
+            fetch = requests.get
+        if max_age is None:
+            max_age = self.ttl
+
+        cached = self.lookup(url)
+        if cached is not None and time.time() - cached.fetched < max_age:
+            details['cache'] = 'hit'
+            return cached
+
+        headers = {}
+        if cached is not None:
+            if 'ETag' in cached.headers:
+                headers['If-None-Match'] = cached.headers['ETag']
+            if 'Last-Modified' in cached.headers:
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
+
+        resp = fetch(url, headers=headers)
+        if resp.status_code == 304 and cached is not None:
+            # still valid, just refresh its timestamp
+            details['cache'] = 'revalidated'
+            self.put(url, cached.content, cached.headers, cached.encoding)
+            return cached
+
+        details['cache'] = 'miss'
+        details['bytes'] = len(resp.content)
+        validators = {k: resp.headers[k] for k in ('ETag', 'Last-Modified') if k in resp.headers}
+        if resp.status_code == 200:
+            self.put(url, resp.content, validators, resp.encoding)
+        return CachedResponse(
+            url, resp.status_code, resp.content, resp.headers, resp.encoding, from_cache=False)
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """Return the cache shared in the process, with default settings."""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = Cache()
+    return _default_cache
+
+
+def get(url, fetch=None, max_age=None):
+    """Get the url using the default cache."""
+    return default_cache().get(url, fetch=fetch, max_age=max_age)
+
+
+def forget(url):
+    """Remove the url from the default cache."""
+    default_cache().forget(url)
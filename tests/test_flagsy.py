@@ -0,0 +1,182 @@
+import ast
+import os
+
+import pytest
+
+import flagsy
+
+
+@pytest.fixture
+def basedir(tmp_path, monkeypatch):
+    """Build everything in a temporary directory."""
+    stamps_dir = str(tmp_path / '.build')
+    monkeypatch.setattr(flagsy, 'BASEDIR', str(tmp_path))
+    monkeypatch.setattr(flagsy, 'STAMPS_DIR', stamps_dir)
+    monkeypatch.setattr(flagsy, 'METRICS_DIR', os.path.join(stamps_dir, 'metrics'))
+    monkeypatch.setattr(flagsy, 'REPORT_PATH', os.path.join(stamps_dir, 'report.json'))
+    (tmp_path / 'source').write_text("original")
+    return tmp_path
+
+
+def _stage(basedir, name, inputs, depends=(), log=None, fail=False):
+    """Build a stage that writes its output (named after it) with the content of its inputs."""
+    def command():
+        if log is not None:
+            log.append(name)
+        if fail:
+            raise RuntimeError("crashed")
+        content = "".join(
+            (basedir / path).read_text() for path in inputs if (basedir / path).is_file())
+        (basedir / (name + '.out')).write_text(content)
+    return flagsy.Stage(name, '', command, inputs, [name + '.out'], depends=depends)
+
+
+def _statuses(results):
+    return {name: status for name, (status, _, _) in results.items()}
+
+
+def test_order(basedir):
+    log = []
+    stages = [
+        _stage(basedir, 'last', ['first.out', 'other.out'], ['first', 'other'], log=log),
+        _stage(basedir, 'first', ['source'], log=log),
+        _stage(basedir, 'other', ['source'], log=log),
+    ]
+    results = flagsy.build(stages, jobs=2)
+    assert _statuses(results) == {'first': 'done', 'other': 'done', 'last': 'done'}
+    assert sorted(log[:2]) == ['first', 'other']
+    assert log[2] == 'last'
+    assert (basedir / 'last.out').read_text() == "originaloriginal"
+
+
+def test_skip_after_failure(basedir):
+    log = []
+    stages = [
+        _stage(basedir, 'first', ['source'], fail=True, log=log),
+        _stage(basedir, 'second', ['first.out'], ['first'], log=log),
+        _stage(basedir, 'third', ['second.out'], ['second'], log=log),
+        _stage(basedir, 'other', ['source'], log=log),
+    ]
+    results = flagsy.build(stages)
+    assert _statuses(results) == {
+        'first': 'failed', 'second': 'skipped', 'third': 'skipped', 'other': 'done'}
+    assert sorted(log) == ['first', 'other']
+
+
+def test_output_not_produced(basedir):
+    stage = flagsy.Stage('lazy', '', lambda: None, ['source'], ['lazy.out'])
+    assert _statuses(flagsy.build([stage])) == {'lazy': 'failed'}
+    assert not os.path.exists(flagsy._stamp_path(stage))
+
+
+def test_missing_input(basedir):
+    stages = [_stage(basedir, 'first', ['nonexistent'])]
+    assert _statuses(flagsy.build(stages)) == {'first': 'failed'}
+
+
+def test_cycle(basedir):
+    stages = [
+        _stage(basedir, 'first', ['source'], ['second']),
+        _stage(basedir, 'second', ['source'], ['first']),
+    ]
+    with pytest.raises(ValueError):
+        flagsy.build(stages)
+
+
+def test_unknown_dependency(basedir):
+    with pytest.raises(ValueError):
+        flagsy.build([_stage(basedir, 'first', ['source'], ['nonexistent'])])
+
+
+def test_stamps(basedir):
+    log = []
+    stages = [
+        _stage(basedir, 'first', ['source'], log=log),
+        _stage(basedir, 'second', ['first.out'], ['first'], log=log),
+    ]
+    flagsy.build(stages)
+    assert log == ['first', 'second']
+
+    # nothing changed
+    results = flagsy.build(stages)
+    assert _statuses(results) == {'first': 'up to date', 'second': 'up to date'}
+    assert log == ['first', 'second']
+
+    # the input changed, so both run again (the second one because its input also changed)
+    (basedir / 'source').write_text("changed!")
+    results = flagsy.build(stages)
+    assert _statuses(results) == {'first': 'done', 'second': 'done'}
+    assert (basedir / 'second.out').read_text() == "changed!"
+
+    # an output is missing
+    os.remove(str(basedir / 'second.out'))
+    results = flagsy.build(stages)
+    assert _statuses(results) == {'first': 'up to date', 'second': 'done'}
+
+
+def test_stamps_directory_input(basedir):
+    (basedir / 'images').mkdir()
+    (basedir / 'images' / 'one.png').write_text("image")
+    log = []
+    stages = [_stage(basedir, 'first', ['source', 'images'], log=log)]
+    flagsy.build(stages)
+    flagsy.build(stages)
+    assert log == ['first']
+
+    (basedir / 'images' / 'two.png').write_text("other image")
+    flagsy.build(stages)
+    assert log == ['first', 'first']
+
+
+def test_force(basedir):
+    log = []
+    stages = [
+        _stage(basedir, 'first', ['source'], log=log),
+        _stage(basedir, 'second', ['source'], log=log),
+    ]
+    flagsy.build(stages)
+    log.clear()
+
+    results = flagsy.build(stages, force=['second'])
+    assert _statuses(results) == {'first': 'up to date', 'second': 'done'}
+    assert log == ['second']
+
+    log.clear()
+    flagsy.build(stages, force=['all'])
+    assert sorted(log) == ['first', 'second']
+
+
+def _local_imports(path):
+    """Return the project's modules imported by the script (and by those modules), as paths."""
+    found = set()
+    pending = [path]
+    while pending:
+        path = pending.pop()
+        with open(os.path.join(flagsy.BASEDIR, path), "rt", encoding="utf8") as fh:
+            tree = ast.parse(fh.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module_path = os.path.join(os.path.dirname(path), name + '.py')
+                fullpath = os.path.join(flagsy.BASEDIR, module_path)
+                if not os.path.exists(fullpath):
+                    continue
+                # the modules shared by both directories are linked from where they live
+                module_path = os.path.relpath(os.path.realpath(fullpath), flagsy.BASEDIR)
+                if module_path not in found:
+                    found.add(module_path)
+                    pending.append(module_path)
+    return found
+
+
+@pytest.mark.parametrize('stage', [s for s in flagsy.STAGES if not callable(s.command)],
+                         ids=lambda stage: stage.name)
+def test_stages_declare_their_modules(stage):
+    script = os.path.join(stage.directory, stage.command[0])
+    assert os.path.normpath(script) in stage.inputs
+    assert _local_imports(os.path.normpath(script)) <= set(stage.inputs)
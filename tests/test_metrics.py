@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+
+import pytest
+
+import metrics
+
+EVENTS = [
+    {'kind': 'http', 'duration': 0.5, 'bytes': 2048, 'cache': 'miss', 'country': 'Argentina'},
+    {'kind': 'http', 'duration': 0.1, 'bytes': 0, 'cache': 'hit', 'country': 'Argentina'},
+    {'kind': 'http', 'duration': 0.3, 'bytes': 1024, 'cache': 'miss'},
+    {'kind': 'parse', 'duration': 0.2, 'country': 'Chile'},
+]
+
+
+@pytest.fixture(autouse=True)
+def clean_events():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_summarize():
+    summary = metrics.summarize(EVENTS)
+    assert summary['http'] == {
+        'count': 3, 'total': pytest.approx(0.9), 'max': 0.5, 'mean': pytest.approx(0.3),
+        'bytes': 3072, 'cache': {'miss': 2, 'hit': 1}}
+    assert summary['parse'] == {'count': 1, 'total': 0.2, 'max': 0.2, 'mean': 0.2}
+
+
+def test_summarize_nothing():
+    assert metrics.summarize([]) == {}
+
+
+def test_build_report():
+    report = metrics.build_report('fill_country_info', EVENTS, 3.5)
+    assert report['stage'] == 'fill_country_info'
+    assert report['duration'] == 3.5
+    assert report['events'] == EVENTS
+    assert report['summary'] == metrics.summarize(EVENTS)
+
+    # the events without a country only count in the general summary
+    assert sorted(report['countries']) == ['Argentina', 'Chile']
+    assert report['countries']['Argentina']['http']['count'] == 2
+    assert report['countries']['Argentina']['http']['bytes'] == 2048
+    assert report['countries']['Chile'] == {'parse': metrics.summarize(EVENTS[3:])['parse']}
+
+
+def test_format_table_aligned():
+    events = EVENTS + [{'kind': 'a-very-long-kind-of-event', 'duration': 12.5}]
+    table = metrics.format_table([
+        metrics.build_report('fill_country_info', events, 1),
+        metrics.build_report('x', EVENTS[:1], 1)])
+    header, *rows, slowest = table.split("\n")
+    assert len(rows) == 4
+    for column in ("kind", "count", "total(s)"):
+        position = header.index(column)
+        if column == "kind":
+            assert all(row[position - 2:position] == "  " for row in rows)
+        else:
+            # right aligned: all values end where the header ends
+            end = position + len(column)
+            assert all(row[end - 1] != " " and row[end] == " " for row in rows)
+    assert slowest == "Slowest countries: Argentina (1.10s), Chile (0.20s)"
+
+
+def test_measure_and_country():
+    with metrics.for_country('Perú'):
+        with metrics.measure('render', card='card.pdf') as details:
+            details['bytes'] = 10
+    metrics.record('convert', 1.5)
+
+    render, convert = metrics.pop_events()
+    assert render['kind'] == 'render'
+    assert render['country'] == 'Perú'
+    assert (render['card'], render['bytes']) == ('card.pdf', 10)
+    assert render['duration'] >= 0
+    assert convert == {'kind': 'convert', 'duration': 1.5}
+    assert metrics.pop_events() == []
+
+
+def test_country_per_thread():
+    def in_thread():
+        metrics.record('http', 1)
+
+    with metrics.for_country('Perú'):
+        thread = threading.Thread(target=in_thread)
+        thread.start()
+        thread.join()
+    (event,) = metrics.pop_events()
+    assert 'country' not in event
+
+
+def test_save_report(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(metrics, 'REPORT_DIR', str(tmp_path / 'metrics'))
+    metrics.extend(EVENTS)
+    report_path = metrics.save_report('some_step')
+
+    assert report_path == os.path.join(str(tmp_path / 'metrics'), 'some_step.json')
+    with open(report_path, "rt", encoding="utf8") as fh:
+        report = json.load(fh)
+    assert report['summary']['http']['count'] == 3
+    assert "Metrics saved in" in capsys.readouterr().out
+    assert metrics.pop_events() == []